@@ -0,0 +1,343 @@
+'''
+Benchmarks for the hot paths from each chapter, run against Redis with
+varying pipeline depth, transactions, concurrency, and payload size.
+
+    $ python benchmark_suite.py --depth 1,10,100 --concurrency 1,4 \
+        --payload 10,1000 --output results.json
+    $ python benchmark_suite.py --fake --baseline results.json
+
+Results are printed (or written) as a JSON list with one entry per
+configuration, including ops/second, p50/p99/p999 latency, and the number
+of round trips to Redis per operation. Pass --fake to use an in-process
+fakeredis server instead of a real Redis (threads only). Benchmarks use
+db 15 by default, which is flushed before every configuration, just like
+the tests for each chapter.
+'''
+
+import argparse
+import json
+import multiprocessing
+import sys
+import threading
+import time
+import unittest
+
+import redis
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+import ch01_listing_source as ch01
+import ch02_listing_source as ch02
+import ch05_listing_source as ch05
+import ch06_listing_source as ch06
+import ch07_listing_source as ch07
+import ch08_listing_source as ch08
+
+def setup_votes(conn, payload):
+    return [ch01.post_article(conn, 'user:0', payload, 'http://example.com/')
+        for i in range(100)]
+
+def vote(conn, worker, i, payload, articles):
+    ch01.article_vote(conn, 'user:%s:%s'%(worker, i),
+        'article:%s'%articles[i % len(articles)])
+
+def update_session(conn, worker, i, payload, state):
+    ch02.update_token(conn, 'token:%s:%s'%(worker, i % 1000), payload,
+        'item:%s'%(i % 100))
+
+def update_counter(conn, worker, i, payload, state):
+    ch05.update_counter(conn, 'hits:%s'%(i % 10))
+
+def push_pop_queue(conn, worker, i, payload, state):
+    ch06.send_sold_email_via_queue(conn, 'seller', payload, 10, 'buyer')
+    conn.lpop('queue:email')
+
+def lock_unlock(conn, worker, i, payload, state):
+    lockname = 'bench:%s'%(i % 8)
+    identifier = ch06.acquire_lock_with_timeout(conn, lockname)
+    if identifier:
+        ch06.release_lock(conn, lockname, identifier)
+
+def setup_search(conn, payload):
+    words = ' '.join('word%s'%(i % 50) for i in range(len(payload) // 7 + 1))
+    for docid in range(100):
+        ch07.index_document(conn, docid, 'redis benchmark ' + words)
+        conn.hset('kb:doc:%s'%docid, mapping={'id': docid, 'updated': docid})
+
+def search(conn, worker, i, payload, state):
+    ch07.search_and_sort(conn, 'redis benchmark', ttl=1)
+
+def setup_syndication(conn, payload):
+    poster = ch08.create_user(conn, 'poster', 'Poster')
+    for i in range(100):
+        ch08.follow_user(conn, ch08.create_user(conn, 'user%s'%i, 'User'), poster)
+    return poster
+
+def syndicate(conn, worker, i, payload, poster):
+    ch08.post_status(conn, poster, payload)
+
+# Each workload is (setup, operation, pipelinable), where only pipelinable
+# operations can be sent on a pipeline, because they don't use any replies
+WORKLOADS = {
+    'session': (None, update_session, True),
+    'vote': (setup_votes, vote, False),
+    'counter': (None, update_counter, False),
+    'queue': (None, push_pop_queue, True),
+    'search': (setup_search, search, False),
+    'syndication': (setup_syndication, syndicate, False),
+    'lock': (None, lock_unlock, False),
+}
+
+def count_round_trips(conn):
+    counts = [0]
+    lock = threading.Lock()
+    base = conn.connection_pool.connection_class
+    class CountingConnection(getattr(base, 'base_class', base)):
+        base_class = getattr(base, 'base_class', base)
+        def send_packed_command(self, *args, **kwargs):
+            with lock:
+                counts[0] += 1                      # Every call is one write to Redis, followed by reading the replies
+            return super(CountingConnection, self).send_packed_command(
+                *args, **kwargs)
+    conn.connection_pool.connection_class = CountingConnection
+    conn.connection_pool.reset()                    # Replace any connections made before we started counting
+    return counts
+
+def run_operations(conn, name, worker, payload, depth, transaction,
+                   duration, state):
+    operation, pipelinable = WORKLOADS[name][1:]
+    ops = 0
+    latencies = []
+    end = time.time() + duration
+    while time.time() < end:
+        start = time.time()
+        if pipelinable and (depth > 1 or transaction):
+            pipe = conn.pipeline(transaction)
+            for i in range(ops, ops + depth):
+                operation(pipe, worker, i, payload, state)
+            pipe.execute()
+            ops += depth
+            latencies.extend([time.time() - start] * depth) # Every operation in the pipeline waited this long for its reply
+        else:
+            operation(conn, worker, ops, payload, state)
+            ops += 1
+            latencies.append(time.time() - start)
+    return ops, latencies
+
+def process_worker(args):
+    redis_kwargs = args[0]
+    conn = redis.Redis(**redis_kwargs)
+    counts = count_round_trips(conn)
+    ops, latencies = run_operations(conn, *args[1:])
+    return ops, latencies, counts[0]
+
+def percentile(latencies, p):
+    if not latencies:
+        return None
+    return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+MODES = ('thread', 'process')
+
+def run_benchmark(conn, name, payload=10, depth=1, transaction=False,
+                  concurrency=1, mode='thread', duration=1,
+                  redis_kwargs=None):
+    if mode not in MODES:
+        raise ValueError("mode must be one of %s, not %r"%(MODES, mode))
+    conn.flushdb()
+    setup = WORKLOADS[name][0]
+    payload = 'x' * payload
+    state = setup(conn, payload) if setup else None
+
+    start = time.time()
+    if mode == 'process':
+        args = [(redis_kwargs, name, worker, payload, depth, transaction,
+            duration, state) for worker in range(concurrency)]
+        pool = multiprocessing.Pool(concurrency)
+        try:
+            results = pool.map(process_worker, args)
+        finally:
+            pool.close()
+            pool.join()
+        round_trips = sum(result[2] for result in results)
+    else:
+        counts = count_round_trips(conn)
+        results = []
+        def worker(worker):
+            results.append(run_operations(conn, name, worker, payload,
+                depth, transaction, duration, state))
+        threads = [threading.Thread(target=worker, args=(i,))
+            for i in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        round_trips = counts[0]
+    delta = time.time() - start
+
+    ops = sum(result[0] for result in results)
+    latencies = sorted(l for result in results for l in result[1])
+    return {
+        'workload': name,
+        'payload': len(payload),
+        'depth': depth,
+        'transaction': transaction,
+        'concurrency': concurrency,
+        'mode': mode,
+        'ops': ops,
+        'seconds': delta,
+        'ops_per_second': ops / delta,
+        'p50': percentile(latencies, .5),
+        'p99': percentile(latencies, .99),
+        'p999': percentile(latencies, .999),
+        'round_trips_per_op': round_trips / float(ops) if ops else None,
+    }
+
+def run_suite(conn, workloads=None, payloads=(10,), depths=(1,),
+              transactions=(False,), concurrencies=(1,), modes=('thread',),
+              duration=1, redis_kwargs=None):
+    results = []
+    for name in workloads or sorted(WORKLOADS):
+        pipelinable = WORKLOADS[name][2]
+        for payload in payloads:
+            for depth in (depths if pipelinable else (1,)):     # Other workloads need replies before they can continue
+                for transaction in (transactions if pipelinable else (False,)):
+                    for concurrency in concurrencies:
+                        for mode in modes:
+                            results.append(run_benchmark(conn, name,
+                                payload, depth, transaction, concurrency,
+                                mode, duration, redis_kwargs))
+    return results
+
+CONFIGURATION = ('workload', 'payload', 'depth', 'transaction',
+                 'concurrency', 'mode')
+
+def compare_results(baseline, results, tolerance=.2):
+    old = dict((tuple(r[k] for k in CONFIGURATION), r) for r in baseline)
+    regressions = []
+    for result in results:
+        previous = old.get(tuple(result[k] for k in CONFIGURATION))
+        if previous and result['ops_per_second'] < \
+                previous['ops_per_second'] * (1 - tolerance):
+            regressions.append((previous, result))
+    return regressions
+
+def parse_list(convert):
+    return lambda value: [convert(v) for v in value.split(',') if v]
+
+def parse_bool(value):
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+def parse_modes(value):
+    modes = []
+    for mode in parse_list(str)(value):
+        if mode not in MODES + ('both',):
+            raise argparse.ArgumentTypeError(
+                "mode must be thread, process, or both, not %r"%mode)
+        for m in (MODES if mode == 'both' else (mode,)):  # 'both' is shorthand for every mode
+            if m not in modes:
+                modes.append(m)
+    return modes
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--fake', action='store_true',
+        help='use an in-process fakeredis server')
+    parser.add_argument('--workloads', type=parse_list(str),
+        default=sorted(WORKLOADS))
+    parser.add_argument('--payload', type=parse_list(int), default=[10])
+    parser.add_argument('--depth', type=parse_list(int), default=[1])
+    parser.add_argument('--transaction', type=parse_list(parse_bool),
+        default=[False])
+    parser.add_argument('--concurrency', type=parse_list(int), default=[1])
+    parser.add_argument('--mode', type=parse_modes, default=['thread'],
+        help='thread, process, or both')
+    parser.add_argument('--duration', type=float, default=1)
+    parser.add_argument('--output', help='write results to this file')
+    parser.add_argument('--baseline',
+        help='exit with an error if ops/second dropped compared to this file')
+    parser.add_argument('--tolerance', type=float, default=.2)
+    args = parser.parse_args(argv)
+
+    redis_kwargs = {'host': args.host, 'port': args.port, 'db': args.db}
+    if args.fake:
+        if fakeredis is None:
+            parser.error('--fake requires the fakeredis package')
+        if 'process' in args.mode:
+            parser.error('--fake only supports --mode thread')
+        conn = fakeredis.FakeRedis()
+    else:
+        conn = redis.Redis(**redis_kwargs)
+
+    results = run_suite(conn, args.workloads, args.payload, args.depth,
+        args.transaction, args.concurrency, args.mode, args.duration,
+        redis_kwargs)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_results(json.load(f), results, args.tolerance)
+        for previous, result in regressions:
+            print("regression:", dict((k, result[k]) for k in CONFIGURATION),
+                previous['ops_per_second'], '->', result['ops_per_second'],
+                file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+#--------------- Below this line are helpers to test the code ----------------
+
+class TestBenchmarkSuite(unittest.TestCase):
+    def setUp(self):
+        import redis
+        self.conn = redis.Redis(host="redis-in-action-redis", db=15)
+        self.conn.flushdb()
+
+    def tearDown(self):
+        self.conn.flushdb()
+        del self.conn
+        print()
+        print()
+
+    def test_run_suite(self):
+        results = run_suite(self.conn, depths=(1, 10),
+            transactions=(False, True), concurrencies=(2,), duration=.1)
+        print(json.dumps(results, indent=2))
+        self.assertEqual(len(results), 13)
+        for result in results:
+            self.assertTrue(result['ops'] > 0)
+            self.assertTrue(result['p50'] <= result['p99'] <= result['p999'])
+        session = dict(((r['depth'], r['transaction']), r)
+            for r in results if r['workload'] == 'session')
+        # Connecting takes a few round trips of its own
+        self.assertTrue(5 <= session[1, False]['round_trips_per_op'] < 5.5)
+        self.assertTrue(1 <= session[1, True]['round_trips_per_op'] < 1.5)
+        self.assertTrue(.1 <= session[10, True]['round_trips_per_op'] < .2)
+        self.assertTrue(.1 <= session[10, False]['round_trips_per_op'] < .2)
+
+        self.assertFalse(compare_results(results, results))
+        slower = [dict(r, ops_per_second=r['ops_per_second'] / 2) for r in results]
+        self.assertEqual(len(compare_results(results, slower)), 13)
+
+        print("Pipelines record a latency for every operation they ran")
+        ops, latencies = run_operations(self.conn, 'session', 0, 'x', 10,
+            False, .05, None)
+        self.assertEqual(len(latencies), ops)
+
+        print("Unknown modes are rejected rather than run as threads")
+        self.assertEqual(parse_modes('both'), ['thread', 'process'])
+        self.assertEqual(parse_modes('process,thread'), ['process', 'thread'])
+        self.assertRaises(argparse.ArgumentTypeError, parse_modes, 'thread,threads')
+        self.assertRaises(ValueError, run_benchmark, self.conn, 'session',
+            mode='both')
+
+if __name__ == '__main__':
+    sys.exit(main())
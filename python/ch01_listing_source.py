@@ -1,6 +1,11 @@
 
+import hashlib
+import random
 import time
 import unittest
+import uuid
+
+import redis
 
 '''
 # <start id="simple-string-calls"/>
@@ -255,6 +260,512 @@ def get_group_articles(conn, group, page, order='score:'):
 #E Call our earlier get_articles() function to handle pagination and article data fetching
 #END
 
+# <start id="fetch-articles-batched"/>
+ARTICLE_FIELDS = ('title', 'link', 'votes', 'time')
+ARTICLE_CACHE = {}
+ARTICLE_CACHE_SIZE = 1000
+
+def get_articles_batched(conn, page, order='score:', fields=None, timeout=0):
+    fields = tuple(fields) if fields else None
+    cache_key = (order, page, fields)
+    now = time.time()
+    if timeout:
+        cached = ARTICLE_CACHE.get(cache_key)           #A
+        if cached and cached[0] > now:                  #A
+            return cached[1]                            #A
+
+    start = (page-1) * ARTICLES_PER_PAGE
+    end = start + ARTICLES_PER_PAGE - 1
+    ids = conn.zrevrange(order, start, end)
+
+    pipe = conn.pipeline(False)                         #B
+    for id in ids:                                      #B
+        if fields:                                      #C
+            pipe.hmget(id, fields)                      #C
+        else:
+            pipe.hgetall(id)                            #B
+
+    articles = []
+    for id, article_data in zip(ids, pipe.execute()):   #D
+        if fields:
+            article_data = dict(zip(fields, article_data))
+        article_data['id'] = id
+        articles.append(article_data)
+
+    if timeout:
+        if len(ARTICLE_CACHE) >= ARTICLE_CACHE_SIZE:    #E
+            for key, (expires, _) in list(ARTICLE_CACHE.items()):
+                if expires <= now:
+                    ARTICLE_CACHE.pop(key, None)
+            if len(ARTICLE_CACHE) >= ARTICLE_CACHE_SIZE:
+                ARTICLE_CACHE.clear()
+        ARTICLE_CACHE[cache_key] = (now + timeout, articles)
+    return articles
+# <end id="fetch-articles-batched"/>
+#A If we were asked to cache, and we have a fresh copy of this page, return it without talking to Redis
+#B Fetch all of the article hashes with a single non-transactional pipeline, so a page costs two round trips no matter how many articles are on it
+#C Only fetch the requested fields (like ARTICLE_FIELDS) when we don't need the whole article
+#D Attach the ids to the article data, just like get_articles()
+#E Keep the local cache from growing without bound by discarding stale pages first, then everything if necessary
+#END
+
+# <start id="script-load"/>
+def script_load(script):
+    sha = [None]
+    def call(conn, keys=[], args=[], force_eval=False):
+        if not force_eval:
+            if not sha[0]:
+                sha[0] = conn.execute_command(
+                    "SCRIPT", "LOAD", script, parse="LOAD")
+
+            try:
+                return conn.execute_command(
+                    "EVALSHA", sha[0], len(keys), *(keys+args))
+
+            except redis.exceptions.ResponseError as msg:
+                if not msg.args[0].startswith("NOSCRIPT"):
+                    raise
+
+        return conn.execute_command(
+            "EVAL", script, len(keys), *(keys+args))
+
+    return call
+# <end id="script-load"/>
+#END
+
+# <start id="article-vote-lua"/>
+VOTE_BATCH_SIZE = 100
+VOTE_RESULTS = {1: True, 0: False, -1: None}
+GROUPS_CHANGED = -2
+
+def article_vote_bulk(conn, votes, downvote=False):
+    cutoff = time.time() - ONE_WEEK_IN_SECONDS
+    direction = -1 if downvote else 1
+    votes = list(votes)
+    results = []
+    while len(results) < len(votes):
+        batch = votes[len(results):len(results)+VOTE_BATCH_SIZE]    #A
+        ids = [article.partition(':')[-1] for user, article in batch]
+        pipe = conn.pipeline(False)
+        for article_id in ids:
+            pipe.smembers('groups:' + article_id)                   #B
+        keys = ['time:', 'score:']
+        args = [cutoff, VOTE_SCORE, direction]
+        for (user, article), article_id, groups in zip(batch, ids, pipe.execute()):
+            keys.extend([article,                                   #C
+                'voted:' + article_id, 'downvoted:' + article_id,   #C
+                'groups:' + article_id])                            #C
+            keys.extend('score:' + (group.decode()                  #C
+                if isinstance(group, bytes) else group) for group in groups)
+            args.extend([user, len(groups)])
+        results.extend(r for r in article_vote_lua(conn, keys, args)#D
+            if r != GROUPS_CHANGED)                                 #D
+    return [VOTE_RESULTS[r] for r in results]                       #E
+
+def article_vote_script(conn, user, article):
+    return article_vote_bulk(conn, [(user, article)])[0]
+
+def article_downvote_script(conn, user, article):
+    return article_vote_bulk(conn, [(user, article)], True)[0]
+
+article_vote_lua = script_load('''
+local cutoff = tonumber(ARGV[1])
+local score = tonumber(ARGV[2]) * tonumber(ARGV[3])
+local field, other = 'votes', 'downvotes'                       --F
+if tonumber(ARGV[3]) < 0 then                                   --F
+    field, other = other, field                                 --F
+end
+local results = {}
+local k = 3
+for i = 4, #ARGV, 2 do
+    local article, add, rem, groups = KEYS[k], KEYS[k+1], KEYS[k+2], KEYS[k+3]
+    local count = tonumber(ARGV[i+1])
+    local gkeys = {}                                            --G
+    for j = 1, count do                                         --G
+        gkeys[j] = KEYS[k+3+j]                                  --G
+        local group = string.sub(gkeys[j], #KEYS[2] + 1)        --G
+        if redis.call('sismember', groups, group) == 0 then     --G
+            count = -1                                          --G
+        end                                                     --G
+    end                                                         --G
+    if redis.call('scard', groups) ~= count then                --G
+        results[#results + 1] = -2                              --G
+        return results                                          --G
+    end
+    k = k + 4 + count
+    if field == 'downvotes' then
+        add, rem = rem, add
+    end
+    local posted = tonumber(redis.call('zscore', KEYS[1], article))
+    if not posted or posted < cutoff then                       --H
+        results[#results + 1] = -1
+    elseif redis.call('sadd', add, ARGV[i]) == 1 then           --I
+        local delta = score
+        if redis.call('srem', rem, ARGV[i]) == 1 then           --J
+            delta = 2 * score                                   --J
+            redis.call('hincrby', article, other, -1)           --J
+        end
+        redis.call('expire', add, math.floor(posted - cutoff))  --K
+        redis.call('zincrby', KEYS[2], delta, article)          --L
+        redis.call('hincrby', article, field, 1)                --L
+        for _, gkey in ipairs(gkeys) do
+            if redis.call('exists', gkey) == 1 then             --N
+                redis.call('zincrby', gkey, delta, article)     --N
+            end
+        end
+        results[#results + 1] = 1
+    else
+        results[#results + 1] = 0                               --M
+    end
+end
+return results
+''')
+# <end id="article-vote-lua"/>
+#A Apply at most VOTE_BATCH_SIZE votes per script call, so a huge batch of votes can't block Redis for too long
+#B Find the groups that each article belongs to, so that we can pass their rankings to the script
+#C Pass the article, its upvote and downvote SETs, the SET of groups that it belongs to, and the rankings for each of those groups
+#D If an article's groups changed after we fetched them, the script stops at that vote, and we send the rest of the votes again
+#E Translate our result codes into True (vote counted), False (duplicate vote), or None (the article is too old to vote on, or doesn't exist)
+#F Upvotes and downvotes are recorded in opposite SETs and counted in opposite article HASH fields
+#G Check that the groups we were passed are still exactly the article's groups, so the script only touches keys that were passed to it
+#H Check the cutoff on the server, so there is no race between the check and the vote
+#I Only count the vote if the user hasn't already voted this way
+#J If the user had voted the other way, remove that vote, and move the score twice as far
+#K Keep the voting information around only as long as the article can be voted on
+#L Update the score and vote count in the same atomic step as the SADD
+#M The user already voted this way, so don't do anything
+#N Keep any materialized group scores up to date (see get_group_articles_incremental() below)
+#END
+
+# <start id="incremental-group-articles"/>
+GROUP_ORDERS = ('score:', 'time:')
+GROUP_TTL = 86400
+
+def add_remove_groups_incremental(conn, article_id, to_add=[], to_remove=[]):
+    article = 'article:' + article_id
+    groups = list(to_add) + list(to_remove)
+    keys = ['groups:' + article_id] + list(GROUP_ORDERS)
+    for group in groups:
+        keys.append('group:' + group)                               #A
+        keys.extend(order + group for order in GROUP_ORDERS)        #A
+    return update_groups_lua(conn, keys,
+        [article, len(to_add), len(GROUP_ORDERS)] + groups)
+
+update_groups_lua = script_load('''
+local article = ARGV[1]
+local adding = tonumber(ARGV[2])
+local orders = tonumber(ARGV[3])
+for i = 4, #ARGV do
+    local k = 2 + orders + (i - 4) * (orders + 1)
+    if i - 3 <= adding then
+        redis.call('sadd', KEYS[k], article)                        --B
+        redis.call('sadd', KEYS[1], ARGV[i])                        --B
+        for j = 1, orders do
+            local score = redis.call('zscore', KEYS[1 + j], article)
+            if score and redis.call('exists', KEYS[k + j]) == 1 then--C
+                redis.call('zadd', KEYS[k + j], score, article)     --C
+            end
+        end
+    else
+        redis.call('srem', KEYS[k], article)                        --D
+        redis.call('srem', KEYS[1], ARGV[i])                        --D
+        for j = 1, orders do
+            redis.call('zrem', KEYS[k + j], article)                --D
+        end
+    end
+end
+''')
+
+def post_article_with_groups(conn, user, title, link, groups=[]):
+    article_id = post_article(conn, user, title, link)
+    if groups:
+        add_remove_groups_incremental(conn, article_id, groups)
+    return article_id
+
+def article_vote(conn, user, article):
+    return article_vote_script(conn, user, article)                 #E
+
+def add_remove_groups(conn, article_id, to_add=[], to_remove=[]):
+    return add_remove_groups_incremental(                           #E
+        conn, article_id, to_add, to_remove)                        #E
+
+def get_group_articles_incremental(conn, group, page, order='score:',
+                                   lock_timeout=10):
+    key = order + group
+    lockname = 'lock:' + key
+    delay = .001
+    while not conn.expire(key, GROUP_TTL):                          #F
+        identifier = str(uuid.uuid4())
+        if conn.set(lockname, identifier, nx=True, ex=lock_timeout):#G
+            try:
+                pipe = conn.pipeline(True)
+                pipe.zinterstore(key,                               #H
+                    ['group:' + group, order], aggregate='max')     #H
+                pipe.expire(key, GROUP_TTL)                         #H
+                pipe.execute()
+            finally:
+                release_lock_lua(conn, [lockname], [identifier])
+            break
+        time.sleep(delay)                                           #I
+        delay = min(delay * 2, .1)                                  #I
+    return get_articles_batched(conn, page, key)                    #J
+
+release_lock_lua = script_load('''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1]) or true
+end
+''')
+# <end id="incremental-group-articles"/>
+#A Pass every key the script touches: each group's SET, and its rankings for each order
+#B Record group membership in both directions, so that votes can find every group an article is in
+#C Only add the article to group rankings that are already materialized; a group that isn't materialized will be rebuilt in full when it is next read
+#D Removing an article from a group removes it from the group rankings too
+#E From here on, voting and group changes keep the group rankings up to date (post_article() doesn't need to, as a new article isn't in any groups yet)
+#F Reading the rankings keeps them around; the rankings for a group nobody reads expire, and are rebuilt in full when they are next read
+#G Only one caller gets to build the rankings
+#H ZINTERSTORE is atomic, so no vote can slip in between building the rankings and keeping them up to date
+#I Everyone else waits for the builder to finish, backing off as they go; if the builder died, its lock expires, and a waiter builds the rankings instead
+#J Fetch the articles with our pipelined fetch
+#END
+
+# <start id="bitmap-votes"/>
+VOTE_BLOOM_CAPACITY = 64
+VOTE_BLOOM_BITS_PER_VOTE = 10
+VOTE_BLOOM_HASHES = 7
+
+def vote_bits_key(article_id, bloom=False):
+    return ('votebloom:' if bloom else 'votebits:') + article_id
+
+def vote_hashes(user):
+    digest = hashlib.md5(str(user).encode()).digest()
+    return (int.from_bytes(digest[:4], 'little'),                   #A
+            int.from_bytes(digest[4:8], 'little') | 1)              #A
+
+def bloom_stage(index):
+    stage = 0
+    capacity = total = VOTE_BLOOM_CAPACITY
+    while index >= total:                                           #B
+        stage += 1                                                  #B
+        capacity *= 2                                               #B
+        total += capacity                                           #B
+    return stage, capacity * VOTE_BLOOM_BITS_PER_VOTE
+
+def vote_offsets(user, bloom=False, bits=None):
+    if not bloom:
+        return [int(user)]                                          #C
+    h1, h2 = vote_hashes(user)
+    bits = bits or VOTE_BLOOM_CAPACITY * VOTE_BLOOM_BITS_PER_VOTE
+    return [(h1 + i * h2) % bits for i in range(VOTE_BLOOM_HASHES)] #D
+
+def bloom_add(pipe, key, user, index):
+    stage, bits = bloom_stage(index)                                #E
+    key = '%s:%s'%(key, stage)
+    for offset in vote_offsets(user, True, bits):
+        pipe.setbit(key, offset, 1)
+    return key
+
+def post_article_bitmap(conn, user, title, link, bloom=False):
+    article_id = str(conn.incr('article:'))
+    voted = vote_bits_key(article_id, bloom)
+
+    now = time.time()
+    article = 'article:' + article_id
+    pipe = conn.pipeline(True)
+    if bloom:
+        voted = bloom_add(pipe, voted, user, 0)                     #F
+    else:
+        pipe.setbit(voted, int(user), 1)                            #F
+    pipe.expire(voted, ONE_WEEK_IN_SECONDS)
+    pipe.hset(article, mapping={
+        'title': title,
+        'link': link,
+        'poster': user,
+        'time': now,
+        'votes': 1,
+    })
+    pipe.zadd('score:', {article: now + VOTE_SCORE})
+    pipe.zadd('time:', {article: now})
+    pipe.execute()
+    return article_id
+
+def article_vote_bitmap(conn, user, article, bloom=False):
+    cutoff = time.time() - ONE_WEEK_IN_SECONDS
+    article_id = article.partition(':')[-1]
+    if bloom:
+        args = ['bloom'] + list(vote_hashes(user)) + [VOTE_BLOOM_CAPACITY,
+            VOTE_BLOOM_BITS_PER_VOTE, VOTE_BLOOM_HASHES]
+    else:
+        args = ['bits'] + vote_offsets(user)
+    result = article_vote_bitmap_lua(conn,
+        ['time:', 'score:', article, vote_bits_key(article_id, bloom),
+         'groups:' + article_id],
+        [cutoff, VOTE_SCORE] + args)
+    return VOTE_RESULTS[result]
+
+article_vote_bitmap_lua = script_load('''
+local posted = tonumber(redis.call('zscore', KEYS[1], KEYS[3]))
+if not posted or posted < tonumber(ARGV[1]) then
+    return -1
+end
+
+local key = KEYS[4]
+if ARGV[3] == 'bloom' then
+    local h1, h2 = tonumber(ARGV[4]), tonumber(ARGV[5])
+    local hashes = tonumber(ARGV[8])
+    local votes = tonumber(redis.call('hget', KEYS[3], 'votes') or 0)
+    local capacity = tonumber(ARGV[6])
+    local total, stage = capacity, 0
+    local write_stage, write_bits
+    while true do
+        local skey = KEYS[4] .. ':' .. stage
+        local bits = capacity * tonumber(ARGV[7])
+        if not write_stage and votes < total then                   --G
+            write_stage, write_bits = stage, bits                   --G
+        elseif write_stage and redis.call('exists', skey) == 0 then
+            break                                                   --H
+        end
+        local seen = true
+        for i = 0, hashes - 1 do
+            if redis.call('getbit', skey, (h1 + i * h2) % bits) == 0 then
+                seen = false
+                break
+            end
+        end
+        if seen then                                                --I
+            return 0                                                --I
+        end
+        stage = stage + 1
+        capacity = capacity * 2
+        total = total + capacity
+    end
+    key = KEYS[4] .. ':' .. write_stage
+    for i = 0, hashes - 1 do
+        redis.call('setbit', key, (h1 + i * h2) % write_bits, 1)    --J
+    end
+else
+    local new = 0
+    for i = 4, #ARGV do
+        if redis.call('setbit', key, ARGV[i], 1) == 0 then          --K
+            new = 1                                                 --K
+        end
+    end
+    if new == 0 then                                                --L
+        return 0                                                    --L
+    end
+end
+
+redis.call('expire', key, math.floor(posted - tonumber(ARGV[1])))
+redis.call('zincrby', KEYS[2], ARGV[2], KEYS[3])
+redis.call('hincrby', KEYS[3], 'votes', 1)
+for _, group in ipairs(redis.call('smembers', KEYS[5])) do
+    local gkey = KEYS[2] .. group
+    if redis.call('exists', gkey) == 1 then
+        redis.call('zincrby', gkey, ARGV[2], KEYS[3])
+    end
+end
+return 1
+''')
+# <end id="bitmap-votes"/>
+#A Hash the user id to two 32-bit values, which Lua can do exact arithmetic on
+#B A Bloom filter grows by adding filters that are each twice as large as the one before, so articles with few votes only use a small filter
+#C With a bitmap, each user has their own bit, so user ids must be (reasonably dense) integers
+#D With a Bloom filter, users are hashed to several bits using double hashing, so any user id works, at the cost of occasionally rejecting a vote from a user who hasn't voted (a false positive)
+#E The n-th voter is added to the filter that has room for them
+#F The poster gets to vote for their own article, just like post_article()
+#G The article's vote count tells us which filter new votes go into
+#H Stop after the filter that we will add to, and any later filters that exist
+#I The user's bits are all set in one of the filters, so the user (probably) already voted
+#J Add the user to the current filter
+#K Set the user's bit, noting whether it wasn't already set
+#L If the bit was already set, the user already voted
+#END
+
+# <start id="migrate-voted-sets"/>
+def migrate_voted_sets(conn, bloom=False, count=1000):
+    migrated = skipped = 0
+    pipe = conn.pipeline(True)
+    for key in conn.scan_iter('voted:*', count=count):              #A
+        key = key.decode() if isinstance(key, bytes) else key
+        article_id = key.partition(':')[-1]
+        dest = vote_bits_key(article_id, bloom)
+        while True:
+            try:
+                pipe.watch(key)                                     #B
+                if pipe.type(key) not in (b'set', 'set'):
+                    pipe.unwatch()
+                    break
+                users = [user.decode() if isinstance(user, bytes) else user
+                    for user in pipe.sscan_iter(key, count=count)]  #C
+                if not bloom and not all(u.isdigit() for u in users):#D
+                    pipe.unwatch()                                  #D
+                    skipped += 1                                    #D
+                    break                                           #D
+                ttl = pipe.ttl(key)
+
+                pipe.multi()
+                written = set()
+                for index, user in enumerate(users):
+                    if bloom:
+                        written.add(bloom_add(pipe, dest, user, index))#E
+                    else:
+                        pipe.setbit(dest, int(user), 1)             #E
+                        written.add(dest)
+                if ttl > 0:
+                    for wkey in written:
+                        pipe.expire(wkey, ttl)                      #F
+                pipe.delete(key)                                    #G
+                pipe.execute()
+                migrated += 1
+                break
+            except redis.exceptions.WatchError:                     #H
+                pass                                                #H
+    return migrated, skipped
+# <end id="migrate-voted-sets"/>
+#A Incrementally find all of the voting SETs without blocking Redis with KEYS
+#B Watch the SET, so that a vote that arrives while we are copying it isn't lost
+#C Fetch the voters without blocking Redis on huge SETs
+#D Bitmaps can only hold integer user ids, so leave SETs with other ids alone
+#E Set the bits for all of the voters
+#F Keep the voting information around for as long as the original SET would have been
+#G Remove the old SET in the same transaction as creating the replacement, which only succeeds if no one voted while we were copying
+#H Someone voted while we were copying, so copy the SET again
+#END
+
+# <start id="benchmark-vote-memory"/>
+def benchmark_vote_memory(conn, votes=1000000, articles=100, users=1000000):
+    results = {}
+    for case, total in (('popular', votes), ('long tail', articles * 2)):#A
+        for name in ('set', 'bitmap', 'bloom'):
+            keys = set()
+            counts = [0] * articles
+            pipe = conn.pipeline(False)
+            for vote in range(total):                               #B
+                article = vote % articles
+                user = random.randrange(users)
+                key = 'bench:%s:%s'%(name, article)
+                if name == 'set':
+                    pipe.sadd(key, user)
+                elif name == 'bitmap':
+                    pipe.setbit(key, user, 1)
+                else:
+                    key = bloom_add(pipe, key, user, counts[article])
+                counts[article] += 1
+                keys.add(key)
+                if not (vote + 1) % 10000:
+                    pipe.execute()
+            pipe.execute()
+            used = sum(conn.memory_usage(key, samples=0) or 0 for key in keys)#C
+            conn.delete(*keys)
+            results[case, name] = used * 1000000 / total            #D
+            print(case, name, 'bytes per 1M votes:', results[case, name])
+    return results
+# <end id="benchmark-vote-memory"/>
+#A Compare articles with many votes each, and articles with only a couple of votes each
+#B Spread random votes across our articles, adding them with each layout
+#C Ask Redis how much memory each layout actually uses
+#D Normalize to bytes per one million votes
+#END
+
 #--------------- Below this line are helpers to test the code ----------------
 
 class TestCh01(unittest.TestCase):
@@ -303,6 +814,16 @@ class TestCh01(unittest.TestCase):
         print()
         self.assertTrue(len(articles) >= 1)
 
+        print("We can also fetch a page of articles with a single pipeline")
+        articles = get_articles_batched(conn, 1, fields=ARTICLE_FIELDS, timeout=5)
+        pprint.pprint(articles)
+        print()
+        self.assertTrue(len(articles) >= 1)
+        self.assertEqual(set(articles[0]), set(ARTICLE_FIELDS) | set(['id']))
+        self.assertTrue(get_articles_batched(conn, 1, fields=ARTICLE_FIELDS, timeout=5) is articles)
+        self.assertEqual(len(get_articles_batched(conn, 1)), len(get_articles(conn, 1)))
+        ARTICLE_CACHE.clear()
+
         to_del = (
             conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') + 
             conn.keys('article:*') + conn.keys('group:*')
@@ -310,5 +831,140 @@ class TestCh01(unittest.TestCase):
         if to_del:
             conn.delete(*to_del)
 
+    def test_article_vote_script(self):
+        conn = self.conn
+
+        article_id = str(post_article(conn, 'username', 'A title', 'http://www.google.com'))
+        article = 'article:' + article_id
+        print("Let's vote on the article with a few users all at once")
+        r = article_vote_bulk(conn, [('user1', article), ('user2', article), ('user1', article)])
+        print("The votes were counted?", r)
+        self.assertEqual(r, [True, True, False])
+        self.assertEqual(int(conn.hget(article, 'votes')), 3)
+        self.assertEqual(conn.zscore('score:', article), conn.zscore('time:', article) + 3 * VOTE_SCORE)
+
+        print("user1 changed their mind, and downvotes the article")
+        self.assertTrue(article_downvote_script(conn, 'user1', article))
+        self.assertFalse(article_downvote_script(conn, 'user1', article))
+        self.assertEqual(int(conn.hget(article, 'votes')), 2)
+        self.assertEqual(int(conn.hget(article, 'downvotes')), 1)
+        self.assertEqual(conn.zscore('score:', article), conn.zscore('time:', article) + VOTE_SCORE)
+        self.assertTrue(article_vote_script(conn, 'user1', article))
+        self.assertEqual(int(conn.hget(article, 'downvotes')), 0)
+
+        print("Articles we don't know about can't be voted on")
+        self.assertEqual(article_vote_script(conn, 'user1', 'article:unknown'), None)
+
+        to_del = (
+            conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') +
+            conn.keys('article:*') + conn.keys('downvoted:*')
+        )
+        if to_del:
+            conn.delete(*to_del)
+
+    def test_group_articles_incremental(self):
+        conn = self.conn
+
+        print("Let's post a couple of articles to a group")
+        a1 = post_article_with_groups(conn, 'username', 'A title', 'http://www.google.com', ['inc-group'])
+        a2 = post_article_with_groups(conn, 'username', 'B title', 'http://www.google.com', ['inc-group'])
+        articles = get_group_articles_incremental(conn, 'inc-group', 1)
+        self.assertEqual([a[b'title'] for a in articles], [b'B title', b'A title'])
+        self.assertTrue(conn.ttl('score:inc-group') > 0)
+
+        print("Votes update the group rankings without rebuilding them")
+        for user in ('user1', 'user2'):
+            article_vote_script(conn, user, 'article:' + a1)
+        self.assertEqual(conn.zscore('score:inc-group', 'article:' + a1), conn.zscore('score:', 'article:' + a1))
+        articles = get_group_articles_incremental(conn, 'inc-group', 1)
+        self.assertEqual([a[b'title'] for a in articles], [b'A title', b'B title'])
+
+        print("As does adding and removing articles from groups")
+        a3 = post_article_with_groups(conn, 'username', 'C title', 'http://www.google.com')
+        add_remove_groups_incremental(conn, a3, ['inc-group'])
+        add_remove_groups_incremental(conn, a1, [], ['inc-group'])
+        articles = get_group_articles_incremental(conn, 'inc-group', 1, 'time:')
+        self.assertEqual([a[b'title'] for a in articles], [b'C title', b'B title'])
+        self.assertEqual(conn.zcard('score:inc-group'), 2)
+
+        print("The original voting and group functions keep the rankings up to date too")
+        for user in ('user3', 'user4', 'user5'):
+            article_vote(conn, user, 'article:' + a2)
+        self.assertEqual(conn.zscore('score:inc-group', 'article:' + a2), conn.zscore('score:', 'article:' + a2))
+        add_remove_groups(conn, a1, ['inc-group'])
+        self.assertEqual(conn.zcard('score:inc-group'), 3)
+
+        print("Votes find out about group changes made after they looked up the groups")
+        keys = ['time:', 'score:', 'article:' + a1, 'voted:' + a1, 'downvoted:' + a1, 'groups:' + a1]
+        args = [time.time() - ONE_WEEK_IN_SECONDS, VOTE_SCORE, 1, 'user6', 0]
+        self.assertEqual(article_vote_lua(conn, keys, args), [GROUPS_CHANGED])
+        self.assertFalse(conn.sismember('voted:' + a1, 'user6'))
+
+        print("Readers wait for a slow builder, and build the rankings themselves if it goes away")
+        conn.delete('score:inc-group')
+        conn.set('lock:score:inc-group', 'someone else', px=100)
+        articles = get_group_articles_incremental(conn, 'inc-group', 1)
+        self.assertEqual(len(articles), 3)
+        self.assertTrue(conn.ttl('score:inc-group') > 0)
+
+        to_del = (
+            conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') +
+            conn.keys('article:*') + conn.keys('group:*') + conn.keys('groups:*')
+        )
+        if to_del:
+            conn.delete(*to_del)
+
+    def test_article_vote_bitmap(self):
+        conn = self.conn
+
+        for bloom in (False, True):
+            print("Let's vote using bits instead of SETs, with bloom =", bloom)
+            article_id = post_article_bitmap(conn, 1, 'A title', 'http://www.google.com', bloom)
+            article = 'article:' + article_id
+            self.assertFalse(article_vote_bitmap(conn, 1, article, bloom))
+            self.assertTrue(article_vote_bitmap(conn, 2, article, bloom))
+            self.assertFalse(article_vote_bitmap(conn, 2, article, bloom))
+            self.assertEqual(int(conn.hget(article, 'votes')), 2)
+            self.assertTrue(conn.ttl(vote_bits_key(article_id, bloom) + (':0' if bloom else '')) > 0)
+
+        print("A Bloom filter grows as an article gets more votes")
+        article_id = post_article_bitmap(conn, 'user0', 'A title', 'http://www.google.com', True)
+        article = 'article:' + article_id
+        for i in range(1, 300):
+            article_vote_bitmap(conn, 'user%s'%i, article, True)
+        votes = int(conn.hget(article, 'votes'))
+        self.assertTrue(votes > 290)
+        self.assertTrue(conn.exists(vote_bits_key(article_id, True) + ':2'))
+        self.assertFalse(conn.exists(vote_bits_key(article_id, True) + ':3'))
+        self.assertFalse(any(article_vote_bitmap(conn, 'user%s'%i, article, True) for i in range(300)))
+        self.assertEqual(int(conn.hget(article, 'votes')), votes)
+
+        print("We can also migrate existing voting SETs")
+        article_id = post_article(conn, '5', 'A title', 'http://www.google.com')
+        article = 'article:' + article_id
+        conn.sadd('voted:' + article_id, '7')
+        self.assertEqual(migrate_voted_sets(conn), (1, 0))
+        self.assertFalse(conn.exists('voted:' + article_id))
+        self.assertFalse(article_vote_bitmap(conn, 7, article))
+        self.assertTrue(article_vote_bitmap(conn, 6, article))
+        article_id = post_article(conn, 'poster', 'A title', 'http://www.google.com')
+        article = 'article:' + article_id
+        conn.sadd('voted:' + article_id, *['user%s'%i for i in range(100)])
+        self.assertEqual(migrate_voted_sets(conn, True), (1, 0))
+        self.assertFalse(article_vote_bitmap(conn, 'user99', article, True))
+        self.assertFalse(article_vote_bitmap(conn, 'poster', article, True))
+
+        print("And compare the memory use of the different layouts")
+        r = benchmark_vote_memory(conn, votes=10000, articles=10, users=100000)
+        self.assertEqual(len(r), 6)
+        self.assertTrue(r['long tail', 'bloom'] < r['long tail', 'bitmap'])
+
+        to_del = (
+            conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') +
+            conn.keys('article:*') + conn.keys('votebits:*') + conn.keys('votebloom:*')
+        )
+        if to_del:
+            conn.delete(*to_del)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,21 @@
 
+from collections import OrderedDict
 import json
+import math
+import random
+import struct
 import threading
 import time
 import unittest
 import urllib.parse
 import uuid
+import zlib
+
+import redis
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 def to_bytes(x):
@@ -204,6 +215,852 @@ def can_cache(conn, request):
 #D Return whether the item has a high enough view count to be cached
 #END
 
+# <start id="session-recorder"/>
+class SessionRecorder(object):
+    def __init__(self, conn, interval=.1, max_events=1000):
+        self.conn = conn
+        self.interval = interval                            #A
+        self.max_events = max_events                        #A
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.quit = False
+        self._reset()
+
+    def _reset(self):
+        self.tokens = {}                                    #B
+        self.views = {}                                     #B
+        self.counts = {}                                    #B
+        self.events = 0
+
+    def update_token(self, token, user, item=None):
+        timestamp = time.time()
+        with self.lock:
+            self.tokens[token] = (user, timestamp)          #C
+            if item:
+                viewed = self.views.setdefault(token, {})   #C
+                viewed.pop(item, None)                      #C
+                viewed[item] = timestamp                    #C
+                if len(viewed) > 25:                        #D
+                    del viewed[next(iter(viewed))]          #D
+                self.counts[item] = self.counts.get(item, 0) + 1
+            self.events += 1
+            full = self.events >= self.max_events
+        if full:
+            self.flush()                                    #E
+
+    def flush(self):
+        with self.flush_lock:                               #F
+            with self.lock:
+                tokens, views, counts = self.tokens, self.views, self.counts
+                self._reset()
+            if not tokens:
+                return 0
+
+            pipe = self.conn.pipeline(False)                #G
+            pipe.hset('login:', mapping=dict(
+                (token, user) for token, (user, _) in tokens.items()))
+            pipe.zadd('recent:', dict(
+                (token, ts) for token, (_, ts) in tokens.items()))
+            for token, viewed in views.items():
+                pipe.zadd('viewed:' + token, viewed)
+                pipe.zremrangebyrank('viewed:' + token, 0, -26)
+            for item, count in counts.items():
+                pipe.zincrby('viewed:', -count, item)
+            pipe.execute()
+            return len(tokens)
+
+    def _run(self):
+        while not self.quit:
+            time.sleep(self.interval)                       #H
+            self.flush()                                    #H
+
+    def start(self):
+        self.quit = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.quit = True
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.flush()                                        #I
+# <end id="session-recorder"/>
+#A Flush every interval seconds, or after max_events calls, whichever comes first
+#B Buffered logins and last-seen times, recently viewed items, and view counts
+#C Repeated updates for the same token or item in one window only keep the most recent login and timestamp
+#D Only keep the most recent 25 items locally, just like Redis will
+#E If we've buffered enough events, flush them right now
+#F Only one flush at a time, so that older updates can't overwrite newer ones
+#G Send everything we buffered in one non-transactional pipeline
+#H Flush periodically from a background thread
+#I Make sure that nothing is lost when we stop
+#END
+
+# <start id="script-load"/>
+def script_load(script):
+    sha = [None]
+    def call(conn, keys=[], args=[], force_eval=False):
+        if not force_eval:
+            if not sha[0]:
+                sha[0] = conn.execute_command(
+                    "SCRIPT", "LOAD", script, parse="LOAD")
+
+            try:
+                return conn.execute_command(
+                    "EVALSHA", sha[0], len(keys), *(keys+args))
+
+            except redis.exceptions.ResponseError as msg:
+                if not msg.args[0].startswith("NOSCRIPT"):
+                    raise
+
+        return conn.execute_command(
+            "EVAL", script, len(keys), *(keys+args))
+
+    return call
+# <end id="script-load"/>
+#END
+
+# <start id="batched-session-cleaner"/>
+SESSION_CLEANER_STATS = {'backlog': 0, 'cleaned': 0, 'passes': 0, 'rate': 0.0}
+STATS_LOCK = threading.Lock()
+CLAIM_TIMEOUT = 60
+
+def clean_sessions_batched(conn, carts=False, max_batch=1000, stats=None):
+    stats = SESSION_CLEANER_STATS if stats is None else stats
+    with STATS_LOCK:
+        stats.setdefault('started', time.time())               #A
+    while not QUIT:
+        popped = claim_sessions_lua(conn, ['recent:', 'recent:claimed'],#B
+            [LIMIT, max_batch, time.time(), CLAIM_TIMEOUT])     #B
+        backlog = popped.pop()                                  #C
+        with STATS_LOCK:
+            stats['backlog'] = backlog                          #C
+        if not popped:
+            time.sleep(1)                                       #D
+            continue
+
+        tokens = [to_str(token) for token in popped]
+        session_keys = ['viewed:' + token for token in tokens]
+        if carts:
+            session_keys.extend('cart:' + token for token in tokens)
+
+        pipe = conn.pipeline(True)                              #E
+        pipe.delete(*session_keys)                              #E
+        pipe.hdel('login:', *tokens)                            #E
+        if carts:
+            pipe.hdel(CART_SNAPSHOTS, *tokens)                  #E
+        pipe.zrem('recent:claimed', *tokens)                    #E
+        pipe.execute()                                          #E
+
+        with STATS_LOCK:                                        #F
+            stats['cleaned'] += len(tokens)                     #F
+            stats['passes'] += 1                                #F
+            stats['rate'] = stats['cleaned'] / max(             #F
+                time.time() - stats['started'], .001)           #F
+
+claim_sessions_lua = script_load('''
+local now = tonumber(ARGV[3])
+local claimed = redis.call('zrangebyscore', KEYS[2], '-inf',    --G
+    now - tonumber(ARGV[4]), 'LIMIT', 0, tonumber(ARGV[2]))     --G
+local backlog = redis.call('zcard', KEYS[1]) - tonumber(ARGV[1])
+local count = math.min(backlog, tonumber(ARGV[2]) - #claimed)   --H
+if count > 0 then
+    local popped = redis.call('zpopmin', KEYS[1], count)        --I
+    for i = 1, #popped, 2 do
+        claimed[#claimed + 1] = popped[i]
+    end
+end
+for i, token in ipairs(claimed) do
+    redis.call('zadd', KEYS[2], now, token)                     --J
+end
+claimed[#claimed + 1] = math.max(backlog - math.max(count, 0), 0)
+return claimed
+''')
+
+def start_session_cleaners(conn, workers=4, carts=False, max_batch=1000,
+                           stats=None):
+    threads = []
+    for i in range(workers):                                    #K
+        t = threading.Thread(target=clean_sessions_batched,     #K
+            args=(conn, carts, max_batch, stats))               #K
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    return threads
+# <end id="batched-session-cleaner"/>
+#A All of our cleaners share their stats, so they also share the time they started cleaning
+#B Atomically claim up to max_batch of the oldest sessions over our limit
+#C The script also tells us how many sessions are still over our limit
+#D We are under our limit, sleep and try again
+#E Delete all of the session data for the whole batch, and release our claim, in one round trip
+#F Update our backlog, and the cleanup rate of all of our cleaners together
+#G Sessions claimed by a cleaner that died before it deleted them are claimed again after CLAIM_TIMEOUT seconds
+#H Size the batch to the backlog, so we can never remove sessions that are under our limit, no matter how many cleaners are running
+#I Claiming with ZPOPMIN means that no two cleaners will ever be handed the same session
+#J Claimed sessions are kept in 'recent:claimed' until their data has been deleted, so they can't be forgotten
+#K Start several cleaners, each of which claims its own batches of sessions
+#END
+
+# <start id="local-page-cache"/>
+INVALIDATE_CHANNEL = 'cache:invalidate'
+
+class LocalPageCache(object):
+    def __init__(self, conn, max_bytes=2**24, timeout=30, refresh=10):
+        self.conn = conn
+        self.max_bytes = max_bytes                          #A
+        self.timeout = timeout                              #A
+        self.refresh = refresh
+        self.pages = OrderedDict()
+        self.size = 0
+        self.cacheable = set()
+        self.lock = threading.Lock()
+        self.quit = False
+        self.threads = []
+        self.refresh_cacheable()                            #A
+
+    def get(self, page_key):
+        with self.lock:
+            page = self.pages.get(page_key)
+            if not page:
+                return None
+            if page[0] < time.time():                       #B
+                self._discard(page_key)                     #B
+                return None
+            self.pages.move_to_end(page_key)                #C
+            return page[1]
+
+    def put(self, page_key, content):
+        with self.lock:
+            self._discard(page_key)
+            size = len(content.encode()                     #E
+                if isinstance(content, str) else content)   #E
+            if size > self.max_bytes:
+                return
+            self.pages[page_key] = (time.time() + self.timeout, content, size)
+            self.size += size
+            while self.size > self.max_bytes:               #D
+                self._discard(next(iter(self.pages)))       #D
+
+    def _discard(self, page_key):
+        page = self.pages.pop(page_key, None)
+        if page:
+            self.size -= page[2]
+
+    def can_cache(self, request):
+        item_id = extract_item_id(request)
+        if not item_id or is_dynamic(request):
+            return False
+        return item_id in self.cacheable                    #F
+
+    def refresh_cacheable(self):
+        items = self.conn.zrange('viewed:', 0, 9999)        #G
+        self.cacheable = set(to_str(item) for item in items)#G
+
+    def cache_request(self, request, callback):
+        if not self.can_cache(request):
+            return callback(request)
+
+        page_key = 'cache:' + hash_request(request)
+        content = self.get(page_key)                        #H
+        if content is None:
+            content = self.conn.get(page_key)               #I
+            if not content:
+                content = callback(request)
+                self.conn.setex(page_key, 300, content)
+            self.put(page_key, content)
+        return content
+
+    def invalidate(self, request):
+        page_key = 'cache:' + hash_request(request)
+        pipe = self.conn.pipeline(True)
+        pipe.delete(page_key)                               #J
+        pipe.publish(INVALIDATE_CHANNEL, page_key)          #J
+        pipe.execute()
+        with self.lock:
+            self._discard(page_key)
+
+    def _refresher(self):
+        while not self.quit:
+            self.refresh_cacheable()
+            end = time.time() + self.refresh
+            while not self.quit and time.time() < end:
+                time.sleep(.05)
+
+    def _listener(self):
+        pubsub = self.conn.pubsub()
+        pubsub.subscribe(INVALIDATE_CHANNEL)
+        try:
+            while not self.quit:
+                message = pubsub.get_message(timeout=.05)
+                if message and message['type'] == 'message':#K
+                    with self.lock:                         #K
+                        self._discard(to_str(message['data']))#K
+        finally:
+            pubsub.close()
+
+    def start(self):
+        self.quit = False
+        for target in (self._refresher, self._listener):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        self.quit = True
+        for t in self.threads:
+            t.join()
+        self.threads = []
+# <end id="local-page-cache"/>
+#A Limit the local cache by the total size of the pages, and keep them for a much shorter time than Redis does; we fetch the most-viewed items right away, so pages can be cached before start() is called
+#B Expired pages are discarded when we find them
+#C Mark the page as recently used
+#D Discard the least recently used pages until we are under our size limit
+#E Pages we generated are strings, pages from Redis are bytes, and we limit both by their size in bytes
+#F Use our snapshot of the most-viewed items instead of calling ZRANK for every request
+#G Refresh the snapshot of the 10,000 most-viewed items, which is the same rule can_cache() uses
+#H Hot pages are served from the local cache without any round trips to Redis
+#I Otherwise fall back to the Redis cache, and generate the page if necessary, just like cache_request()
+#J Remove the page from Redis, and tell every other process to remove it from their local cache
+#K When another process invalidates a page, drop our local copy
+#END
+
+def acquire_lock_with_timeout(
+    conn, lockname, acquire_timeout=10, lock_timeout=10):
+    identifier = str(uuid.uuid4())
+    lockname = 'lock:' + lockname
+    lock_timeout = int(math.ceil(lock_timeout))
+
+    end = time.time() + acquire_timeout
+    while time.time() < end:
+        if conn.setnx(lockname, identifier):
+            conn.expire(lockname, lock_timeout)
+            return identifier
+        elif conn.ttl(lockname) < 0:
+            conn.expire(lockname, lock_timeout)
+
+        time.sleep(.001)
+
+    return False
+
+def release_lock(conn, lockname, identifier):
+    pipe = conn.pipeline(True)
+    lockname = 'lock:' + lockname
+    if isinstance(identifier, str):
+        identifier = identifier.encode()
+
+    while True:
+        try:
+            pipe.watch(lockname)
+            if pipe.get(lockname) == identifier:
+                pipe.multi()
+                pipe.delete(lockname)
+                pipe.execute()
+                return True
+
+            pipe.unwatch()
+            break
+
+        except redis.exceptions.WatchError:
+            pass
+
+    return False
+
+# <start id="single-flight-cache-request"/>
+CACHE_TIMEOUT = 300
+STALE_TIMEOUT = 60
+
+def cache_request_single_flight(conn, request, callback, beta=1.0, wait=.5):
+    if not can_cache(conn, request):
+        return callback(request)
+
+    page_key = 'cache:' + hash_request(request)
+    content, seen = conn.mget(page_key, page_key + ':meta')     #A
+    if content and should_serve(seen, beta):                    #B
+        return content
+
+    while True:
+        locked = acquire_lock_with_timeout(conn, page_key,      #C
+            wait if not content else .001, wait * 10)           #C
+        if locked:
+            break
+        if content:                                             #D
+            return content                                      #D
+        content = conn.get(page_key)                            #E
+        if content:                                             #E
+            return content                                      #E
+
+    try:
+        content, meta = conn.mget(page_key, page_key + ':meta') #F
+        if content and meta != seen:                            #F
+            return content                                      #F
+
+        start = time.time()
+        content = callback(request)
+        delta = time.time() - start
+        pipe = conn.pipeline(True)
+        pipe.setex(page_key, CACHE_TIMEOUT + STALE_TIMEOUT, content)#G
+        pipe.setex(page_key + ':meta', CACHE_TIMEOUT + STALE_TIMEOUT,#G
+            '%r %r'%(start + CACHE_TIMEOUT, delta))             #G
+        pipe.execute()
+        return content
+    finally:
+        release_lock(conn, page_key, locked)
+
+def should_serve(meta, beta):
+    if not meta:
+        return True                                             #H
+    expiry, delta = map(float, meta.split())
+    rand = random.random() or 1e-12
+    return time.time() - delta * beta * math.log(rand) < expiry #I
+# <end id="single-flight-cache-request"/>
+#A Fetch the page and its expiration information in one round trip
+#B Serve the cached page if it is fresh, and we haven't been chosen to refresh it early
+#C Only one caller gets to regenerate the page; if we have a stale copy, we don't wait for the lock at all
+#D Someone else is regenerating the page, so serve the stale copy
+#E We have nothing to serve, so keep waiting until the page shows up or we get the lock, which expires if whoever held it died, instead of generating the page ourselves
+#F Someone else regenerated the page while we were waiting for the lock, so we don't need to
+#G Keep the page around a little longer than it is fresh, so we have something to serve while it is being regenerated, and remember how long it took to generate
+#H Pages cached by cache_request() don't have any expiration information, so serve them until they expire
+#I Probabilistic early expiration (XFetch): the closer we are to expiring, and the longer the page takes to generate, the more likely we are to refresh it early
+#END
+
+# <start id="batched-cache-rows"/>
+def cache_rows_batched(conn, count=100, max_sleep=1, codec='json'):
+    while not QUIT:
+        claimed = claim_rows_lua(conn,                              #A
+            ['schedule:', 'delay:'], [time.time(), count])          #A
+        next_due = claimed.pop(0)
+        if claimed:
+            rows = Inventory.get_many([to_str(row_id) for row_id in claimed])#B
+            pipe = conn.pipeline(False)                             #C
+            for row in rows:                                        #C
+                row = {to_str(k):to_str(v) for k,v in row.to_dict().items()}
+                pipe.set('inv:' + str(row['id']), encode_row(row, codec))#C
+            pipe.execute()                                          #C
+            if len(claimed) == count:
+                continue                                            #D
+
+        delay = max_sleep
+        if next_due:
+            delay = min(float(next_due) - time.time(), max_sleep)   #E
+        if delay > 0:
+            time.sleep(delay)
+
+claim_rows_lua = script_load('''
+local due = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1],  --F
+    'LIMIT', 0, tonumber(ARGV[2]))                                  --F
+local claimed = {false}
+for _, row_id in ipairs(due) do
+    local delay = tonumber(redis.call('zscore', KEYS[2], row_id))
+    if not delay or delay <= 0 then
+        redis.call('zrem', KEYS[2], row_id)                         --G
+        redis.call('zrem', KEYS[1], row_id)                         --G
+        redis.call('del', 'inv:' .. row_id)                         --G
+    else
+        redis.call('zadd', KEYS[1], tonumber(ARGV[1]) + delay, row_id)--H
+        claimed[#claimed + 1] = row_id
+    end
+end
+local next_due = redis.call('zrange', KEYS[1], 0, 0, 'WITHSCORES')
+claimed[1] = next_due[2] or false                                   --I
+return claimed
+''')
+# <end id="batched-cache-rows"/>
+#A Claim every row that is due, up to count rows, in one call
+#B Fetch all of the claimed rows from the database at once
+#C Write all of the cached rows in one round trip
+#D If we claimed a full batch, there may be more rows that are due, so don't sleep
+#E Sleep until the next row is due, but not so long that we miss rows that are scheduled in the meantime
+#F Find the rows that are due
+#G The row shouldn't be cached anymore, so remove it from the cache
+#H Rescheduling the row as part of claiming it means that no other worker will claim it until it is due again
+#I Also tell the caller when the next row is due
+#END
+
+# <start id="row-codecs"/>
+ROW_SCHEMA = (('id', str), ('data', str), ('cached', float))    #A
+COMPRESS_OVER = 1024
+
+def struct_encode(row, schema=ROW_SCHEMA):
+    out = []
+    for name, kind in schema:
+        value = row[name]
+        if kind is float:
+            out.append(struct.pack('<d', value))                #B
+        elif kind is int:
+            out.append(struct.pack('<q', value))                #B
+        else:
+            value = to_bytes(str(value))                        #C
+            out.append(struct.pack('<I', len(value)))           #C
+            out.append(value)                                   #C
+    return b''.join(out)
+
+def struct_decode(data, schema=ROW_SCHEMA):
+    row = {}
+    offset = 0
+    for name, kind in schema:
+        if kind is float or kind is int:
+            fmt = '<d' if kind is float else '<q'
+            row[name], = struct.unpack_from(fmt, data, offset)
+            offset += 8
+        else:
+            size, = struct.unpack_from('<I', data, offset)
+            row[name] = to_str(data[offset+4:offset+4+size])
+            offset += 4 + size
+    return row
+
+CODECS = {                                                      #D
+    b'j': (lambda row: json.dumps(row, separators=(',', ':')).encode(),
+           lambda data: json.loads(data)),
+    b's': (struct_encode, struct_decode),
+}
+if msgpack:                                                     #E
+    CODECS[b'm'] = (msgpack.packb, msgpack.unpackb)             #E
+CODEC_TAGS = {'json': b'j', 'struct': b's', 'msgpack': b'm'}
+
+def encode_row(row, codec='json', compress_over=COMPRESS_OVER):
+    tag = CODEC_TAGS[codec]
+    data = CODECS[tag][0](row)
+    if codec == 'json':
+        return data                                             #F
+    if compress_over is not None and len(data) > compress_over: #G
+        tag, data = tag.upper(), zlib.compress(data)            #G
+    return tag + data                                           #H
+
+def decode_row(data):
+    if not data:
+        return None
+    if data[:1] == b'{':                                        #I
+        return json.loads(data)                                 #I
+    tag, data = data[:1], data[1:]
+    if tag.isupper():
+        tag, data = tag.lower(), zlib.decompress(data)
+    return CODECS[tag][1](data)
+
+def get_cached_rows(conn, row_ids):
+    return [decode_row(data)                                    #J
+        for data in conn.mget(['inv:' + row_id for row_id in row_ids])]
+
+def benchmark_row_codecs(rows):
+    results = {}
+    for codec in sorted(CODEC_TAGS):
+        if CODEC_TAGS[codec] not in CODECS:
+            continue
+        for compress_over in ((None,) if codec == 'json' else (None, 0)):#K
+            name = codec + ('' if compress_over is None else '+zlib')
+            start = time.time()
+            encoded = [encode_row(row, codec, compress_over) for row in rows]
+            encode = time.time() - start
+            start = time.time()
+            for data in encoded:
+                decode_row(data)
+            decode = time.time() - start
+            results[name] = {
+                'bytes': sum(map(len, encoded)) / len(rows),    #L
+                'encode_us': encode * 1000000 / len(rows),      #L
+                'decode_us': decode * 1000000 / len(rows),      #L
+            }
+            print(name, results[name])
+    return results
+# <end id="row-codecs"/>
+#A Struct packing needs to know the fields and types of our rows ahead of time
+#B Numbers are packed into fixed-width binary fields
+#C Strings are packed with their length first
+#D Each codec gets a one-byte tag, which is stored as the first byte of the cached value (except for plain JSON, see #F)
+#E msgpack is only available if it is installed
+#F JSON rows are written as plain JSON, just like cache_rows() writes them, so existing readers of inv:* keep working
+#G Large rows are compressed, which we note by upper-casing the tag
+#H The tag lets readers decode any row, no matter how it was written
+#I Rows cached by cache_rows(), or with the json codec, are plain JSON
+#J Fetch and decode many rows in one round trip
+#K Benchmark each codec with and without compression
+#L Report the average bytes per row, and time per row in microseconds
+#END
+
+# <start id="decayed-views"/>
+VIEW_HALF_LIFE = 300                                            #A
+VIEW_DECAY = math.log(2) / VIEW_HALF_LIFE                       #A
+POPULAR_KEYS = ['popular:', 'popular:epoch', 'popular:next', 'popular:next-epoch']
+
+def record_views(conn, items, now=None, force_eval=False):
+    return record_views_lua(conn, POPULAR_KEYS,
+        [repr(now or time.time()), VIEW_DECAY] + list(items), force_eval)
+
+record_views_lua = script_load('''
+local now = tonumber(ARGV[1])
+local epoch = tonumber(redis.call('get', KEYS[2]) or '')
+if not epoch then
+    redis.call('set', KEYS[2], ARGV[1])                         --B
+    epoch = now
+end
+local next_epoch = tonumber(redis.call('get', KEYS[4]) or '')
+local weight = math.exp(tonumber(ARGV[2]) * (now - epoch))      --C
+for i = 3, #ARGV do
+    redis.call('zincrby', KEYS[1], weight, ARGV[i])
+    if next_epoch then                                          --D
+        redis.call('zincrby', KEYS[3],                          --D
+            math.exp(tonumber(ARGV[2]) * (now - next_epoch)), ARGV[i])
+    end
+end
+''')
+
+def update_token_decayed(conn, token, user, item=None):
+    timestamp = time.time()
+    pipe = conn.pipeline(False)
+    pipe.hset('login:', token, user)
+    pipe.zadd('recent:', {token: timestamp})
+    if item:
+        pipe.zadd('viewed:' + token, {item: timestamp})
+        pipe.zremrangebyrank('viewed:' + token, 0, -26)
+        record_views(pipe, [item], timestamp, force_eval=True)  #E
+    pipe.execute()
+
+def can_cache_decayed(conn, request):
+    item_id = extract_item_id(request)
+    if not item_id or is_dynamic(request):
+        return False
+    rank = conn.zrevrank('popular:', item_id)                   #F
+    return rank is not None and rank < 10000
+
+def get_popular_items(conn, count=10, now=None):
+    pipe = conn.pipeline(False)
+    pipe.get('popular:epoch')
+    pipe.zrevrange('popular:', 0, count-1, withscores=True)
+    epoch, items = pipe.execute()
+    if not epoch:
+        return []
+    scale = math.exp(-VIEW_DECAY * ((now or time.time()) - float(epoch)))
+    return [(item, score * scale) for item, score in items]     #G
+
+def renormalize_popular(conn, chunk=1000, limit=20000, timeout=3600, now=None):
+    now = now or time.time()
+    if not start_renormalize_lua(conn, POPULAR_KEYS, [repr(now), timeout]):
+        return False                                            #H
+
+    cursor = 0
+    while True:
+        cursor, items = conn.zscan('popular:', cursor, count=chunk) #I
+        if items:
+            copy_popular_lua(conn, POPULAR_KEYS,                #J
+                [VIEW_DECAY] + [item for item, score in items]) #J
+        if not cursor:
+            break
+
+    return bool(finish_renormalize_lua(conn, POPULAR_KEYS, [limit]))
+
+start_renormalize_lua = script_load('''
+if not redis.call('get', KEYS[2]) then
+    return false
+end
+if redis.call('set', KEYS[4], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    redis.call('del', KEYS[3])
+    return true
+end
+''')
+
+copy_popular_lua = script_load('''
+local epoch = tonumber(redis.call('get', KEYS[2]))
+local next_epoch = tonumber(redis.call('get', KEYS[4]) or '')
+if not next_epoch then
+    return
+end
+local scale = math.exp(-tonumber(ARGV[1]) * (next_epoch - epoch))
+for i = 2, #ARGV do
+    local score = redis.call('zscore', KEYS[1], ARGV[i])        --K
+    if score then
+        redis.call('zadd', KEYS[3], tonumber(score) * scale, ARGV[i])
+    end
+end
+''')
+
+finish_renormalize_lua = script_load('''
+local next_epoch = redis.call('get', KEYS[4])
+if not next_epoch then
+    redis.call('del', KEYS[3])                                  --L
+    return false
+end
+if redis.call('exists', KEYS[3]) == 1 then
+    redis.call('rename', KEYS[3], KEYS[1])                      --M
+end
+redis.call('set', KEYS[2], next_epoch)                          --M
+redis.call('del', KEYS[4])                                      --M
+redis.call('zremrangebyrank', KEYS[1], 0, -(tonumber(ARGV[1]) + 1))--N
+return true
+''')
+
+def renormalize_viewed(conn, interval=3600):
+    while not QUIT:
+        renormalize_popular(conn)
+        time.sleep(interval)                                    #O
+# <end id="decayed-views"/>
+#A By default, views lose half of their weight every 5 minutes, just like rescale_viewed()
+#B The first view sets the epoch that all weights are relative to
+#C Instead of shrinking old scores, we grow new increments exponentially with time since the epoch, so nothing needs to be rewritten for scores to decay
+#D While we are renormalizing, also update the renormalized copy, relative to the new epoch
+#E Scripts that are run inside pipelines must use EVAL, as we can't recover from a missing script in the middle of a pipeline
+#F Scores are positive, so the most popular items have the highest scores
+#G Convert the scores into decayed view counts as of now
+#H The scores will eventually get too large for a double, so every once in a while we move the epoch up, unless someone else is already doing it
+#I Walk through the ZSET a chunk at a time, so we never block Redis for long
+#J Copy the chunk into the renormalized ZSET, relative to the new epoch
+#K Re-read the score, as it may have changed since ZSCAN returned it
+#L Our renormalization took too long, so throw away the partial copy
+#M Atomically replace the scores and the epoch
+#N Only keep the 20,000 most popular items, like rescale_viewed()
+#O Renormalizing once an hour keeps weights well within the range of a double
+#END
+
+# <start id="cart-store"/>
+CART_SNAPSHOTS = 'cart-snapshots:'
+
+def update_cart(conn, session, deltas):
+    args = [session]
+    for item, delta in deltas.items():
+        args.extend([item, int(delta)])
+    while True:
+        result = update_cart_lua(conn,                          #A
+            ['cart:' + session, CART_SNAPSHOTS], args)          #A
+        if result != -1:
+            return bool(result)                                 #B
+        restore_cart(conn, session)                             #C
+
+update_cart_lua = script_load('''
+if redis.call('exists', KEYS[1]) == 0 and
+        redis.call('hexists', KEYS[2], ARGV[1]) == 1 then
+    return -1                                                   --C
+end
+local totals = {}
+for i = 2, #ARGV, 2 do
+    local item = ARGV[i]
+    local total = totals[item] or tonumber(redis.call('hget', KEYS[1], item) or '0')
+    totals[item] = total + tonumber(ARGV[i+1])
+    if totals[item] < 0 then                                    --D
+        return 0                                                --D
+    end
+end
+for item, total in pairs(totals) do                             --E
+    if total == 0 then                                          --E
+        redis.call('hdel', KEYS[1], item)                       --E
+    else
+        redis.call('hset', KEYS[1], item, total)                --E
+    end
+end
+return 1
+''')
+
+def merge_carts(conn, from_session, to_session):
+    while True:
+        result = merge_carts_lua(conn, ['cart:' + from_session,
+            'cart:' + to_session, CART_SNAPSHOTS], [from_session, to_session])
+        if result != -1:
+            return result
+        restore_cart(conn, from_session)
+        restore_cart(conn, to_session)
+
+merge_carts_lua = script_load('''
+for i = 1, 2 do
+    if redis.call('exists', KEYS[i]) == 0 and
+            redis.call('hexists', KEYS[3], ARGV[i]) == 1 then
+        return -1
+    end
+end
+local items = redis.call('hgetall', KEYS[1])
+for i = 1, #items, 2 do
+    redis.call('hincrby', KEYS[2], items[i], items[i+1])        --F
+end
+redis.call('del', KEYS[1])                                      --F
+return #items / 2
+''')
+
+def pack_cart(cart):
+    out = []
+    for item, count in cart.items():
+        item = to_bytes(item)
+        out.append(struct.pack('<H', len(item)) + item + struct.pack('<i', int(count)))
+    return zlib.compress(b''.join(out))                         #G
+
+def unpack_cart(blob):
+    data = zlib.decompress(blob)
+    cart = {}
+    offset = 0
+    while offset < len(data):
+        size, = struct.unpack_from('<H', data, offset)
+        item = data[offset+2:offset+2+size]
+        cart[item], = struct.unpack_from('<i', data, offset+2+size)
+        offset += 6 + size
+    return cart
+
+def snapshot_idle_carts(conn, idle=30*60, count=100):
+    cutoff = time.time() - idle
+    snapshotted = 0
+    start = 0
+    pipe = conn.pipeline(True)
+    while True:
+        sessions = conn.zrangebyscore('recent:', 0, cutoff, start, count)#H
+        if not sessions:
+            return snapshotted
+        start += len(sessions)
+        for session in sessions:
+            cart = 'cart:' + to_str(session)
+            try:
+                pipe.watch(cart)                                #I
+                items = pipe.hgetall(cart)
+                if not items:
+                    pipe.unwatch()
+                    continue
+                pipe.multi()
+                pipe.hset(CART_SNAPSHOTS, session, pack_cart(items))#J
+                pipe.delete(cart)                               #J
+                pipe.execute()
+                snapshotted += 1
+            except redis.exceptions.WatchError:
+                pass                                            #K
+
+def restore_cart(conn, session):
+    cart = 'cart:' + session
+    pipe = conn.pipeline(True)
+    while True:
+        try:
+            pipe.watch(cart, CART_SNAPSHOTS)
+            blob = pipe.hget(CART_SNAPSHOTS, session)
+            if not blob:
+                pipe.unwatch()
+                return False
+            items = unpack_cart(blob)
+            pipe.multi()
+            for item, count in items.items():
+                pipe.hincrby(cart, item, count)                 #L
+            pipe.hdel(CART_SNAPSHOTS, session)
+            pipe.execute()
+            return True
+        except redis.exceptions.WatchError:
+            pass
+
+def get_cart(conn, session):
+    items = conn.hgetall('cart:' + session)
+    if not items and restore_cart(conn, session):               #M
+        items = conn.hgetall('cart:' + session)
+    return items
+# <end id="cart-store"/>
+#A Apply all of the quantity changes in one atomic step
+#B We return True if the changes were applied, and False if the changes would have left a negative count of any item
+#C The cart was snapshotted, so restore it and try again
+#D Reject the whole batch of changes if any total would be negative
+#E Only now that we know the whole batch is valid do we change the cart
+#F Add the items from one cart to the other, and remove the old cart
+#G Pack the items as length-prefixed names and counts, then compress the whole thing
+#H Find sessions that have been idle long enough
+#I Make sure the cart doesn't change while we snapshot it
+#J Replace the cart with its snapshot, which is stored in a single HASH to save memory
+#K The cart was changed by its user, so leave it alone
+#L Add the counts back with HINCRBY, in case the cart was changed after it was snapshotted
+#M If the cart was snapshotted, restore it before returning it
+#END
+
 
 #--------------- Below this line are helpers to test the code ----------------
 
@@ -228,6 +1085,10 @@ class Inventory(object):
     def get(cls, id):
         return Inventory(id)
 
+    @classmethod
+    def get_many(cls, ids):
+        return [Inventory(id) for id in ids]
+
     def to_dict(self):
         return {'id':self.id, 'data':'data to cache...', 'cached':time.time()}
 
@@ -240,8 +1101,8 @@ class TestCh02(unittest.TestCase):
         conn = self.conn
         to_del = (
             conn.keys('login:*') + conn.keys('recent:*') + conn.keys('viewed:*') +
-            conn.keys('cart:*') + conn.keys('cache:*') + conn.keys('delay:*') + 
-            conn.keys('schedule:*') + conn.keys('inv:*'))
+            conn.keys('cart:*') + conn.keys(CART_SNAPSHOTS) + conn.keys('cache:*') + conn.keys('delay:*') + 
+            conn.keys('schedule:*') + conn.keys('inv:*') + conn.keys('popular:*'))
         if to_del:
             self.conn.delete(*to_del)
         del self.conn
@@ -386,6 +1247,271 @@ class TestCh02(unittest.TestCase):
         if t.isAlive():
             raise Exception("The database caching thread is still alive?!?")
 
+    def test_session_recorder(self):
+        conn = self.conn
+        token = str(uuid.uuid4())
+
+        print("Let's buffer some session updates...")
+        recorder = SessionRecorder(conn, interval=.1, max_events=1000)
+        for i in range(30):
+            recorder.update_token(token, 'username', 'item%s'%(i % 27))
+        self.assertFalse(check_token(conn, token))
+        print("...and flush them in one pipeline")
+        self.assertEqual(recorder.flush(), 1)
+        self.assertEqual(check_token(conn, token), b'username')
+        self.assertEqual(conn.zcard('viewed:' + token), 25)
+        self.assertEqual(conn.zscore('viewed:', 'item0'), -2)
+
+        print("The background thread flushes for us too")
+        recorder.start()
+        recorder.update_token(token, 'username2')
+        time.sleep(.5)
+        self.assertEqual(check_token(conn, token), b'username2')
+        recorder.stop()
+
+    def test_clean_sessions_batched(self):
+        conn = self.conn
+        global LIMIT, QUIT
+
+        print("Let's log in a bunch of users with shopping carts")
+        tokens = [str(uuid.uuid4()) for i in range(50)]
+        for token in tokens:
+            update_token(conn, token, 'username', 'itemX')
+            add_to_cart(conn, token, 'itemY', 1)
+
+        print("And clean out all but 10 of them, with several cleaners")
+        LIMIT = 10
+        stats = {'backlog': 0, 'cleaned': 0, 'passes': 0, 'rate': 0.0}
+        threads = start_session_cleaners(conn, 3, True, 7, stats)
+        time.sleep(1)
+        QUIT = True
+        for t in threads:
+            t.join()
+
+        print("Our cleaner stats are:", stats)
+        self.assertEqual(conn.zcard('recent:'), 10)
+        self.assertEqual(conn.hlen('login:'), 10)
+        self.assertEqual(stats['cleaned'], 40)
+        self.assertEqual(stats['backlog'], 0)
+        self.assertFalse(conn.exists('cart:' + tokens[0]))
+        self.assertTrue(conn.exists('cart:' + tokens[-1]))
+        self.assertFalse(conn.exists('recent:claimed'))
+        self.assertTrue(stats['rate'] >= 40 / (time.time() - stats['started']))
+
+        print("Sessions claimed by a cleaner that died are cleaned later")
+        LIMIT = 5
+        QUIT = False
+        claimed = claim_sessions_lua(conn, ['recent:', 'recent:claimed'],
+            [LIMIT, 2, time.time() - CLAIM_TIMEOUT - 1, CLAIM_TIMEOUT])
+        self.assertEqual(len(claimed), 3)
+        self.assertEqual(conn.zcard('recent:claimed'), 2)
+        threads = start_session_cleaners(conn, 2, True, 7, stats)
+        time.sleep(1)
+        QUIT = True
+        for t in threads:
+            t.join()
+        self.assertEqual(stats['cleaned'], 45)
+        self.assertEqual(conn.hlen('login:'), 5)
+        self.assertFalse(conn.exists('recent:claimed'))
+        for token in claimed[:2]:
+            self.assertFalse(conn.exists('cart:' + to_str(token)))
+
+    def test_local_page_cache(self):
+        conn = self.conn
+        token = str(uuid.uuid4())
+        calls = []
+
+        def callback(request):
+            calls.append(request)
+            return "content for " + request
+
+        update_token(conn, token, 'username', 'itemX')
+        url = 'http://test.com/?item=itemX'
+        cache = LocalPageCache(conn, max_bytes=100)
+        cache.start()
+        try:
+            print("We'll fetch a page, which should be cached in Redis and locally")
+            self.assertEqual(cache.cache_request(url, callback), "content for " + url)
+            self.assertEqual(len(calls), 1)
+            self.assertTrue(conn.get('cache:' + hash_request(url)))
+            print("Our local cache has:", cache.pages)
+            conn.delete('cache:' + hash_request(url))
+            self.assertEqual(cache.cache_request(url, None), "content for " + url)
+
+            print("Invalidating the page from another cache removes our copy")
+            other = LocalPageCache(conn)
+            other.invalidate(url)
+            time.sleep(.5)
+            self.assertFalse(cache.pages)
+            cache.cache_request(url, callback)
+            self.assertEqual(len(calls), 2)
+
+            print("Our local cache won't grow past its size limit")
+            cache.put('cache:big', 'x' * 90)
+            self.assertTrue(cache.size <= 100)
+            self.assertFalse(cache.can_cache('http://test.com/?item=itemY'))
+            print("...which counts bytes, not characters")
+            cache.put('cache:wide', '\u00e9' * 40)
+            self.assertEqual(cache.size, 80)
+            self.assertEqual(list(cache.pages), ['cache:wide'])
+            cache.put('cache:wider', '\u00e9' * 60)
+            self.assertNotIn('cache:wider', cache.pages)
+
+            print("Pages can be cached before the cache is started")
+            self.assertTrue(LocalPageCache(conn).can_cache(url))
+        finally:
+            cache.stop()
+
+    def test_cache_request_single_flight(self):
+        conn = self.conn
+        token = str(uuid.uuid4())
+        calls = []
+
+        def callback(request):
+            calls.append(request)
+            time.sleep(.2)
+            return "content for " + request
+
+        update_token(conn, token, 'username', 'itemX')
+        url = 'http://test.com/?item=itemX'
+        print("Let's request the same page from several threads at once")
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            cache_request_single_flight(conn, url, callback))) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        print("The page was generated this many times:", len(calls))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(set(map(to_bytes, results)), set([to_bytes("content for " + url)]))
+
+        print("Once the page expires, we serve the stale copy while it is regenerated")
+        conn.set('cache:' + hash_request(url) + ':meta', '%r %r'%(time.time() - 1, .2))
+        acquire_lock_with_timeout(conn, 'cache:' + hash_request(url))
+        self.assertEqual(cache_request_single_flight(conn, url, None), to_bytes("content for " + url))
+        conn.delete('lock:cache:' + hash_request(url))
+
+        print("Close to expiring, a slow page is refreshed early")
+        conn.set('cache:' + hash_request(url) + ':meta', '%r %r'%(time.time() + 1, 10))
+        random.seed(0)
+        self.assertEqual(cache_request_single_flight(conn, url, callback), "content for " + url)
+        self.assertEqual(len(calls), 2)
+        meta = conn.get('cache:' + hash_request(url) + ':meta').split()
+        self.assertTrue(float(meta[0]) > time.time() + CACHE_TIMEOUT - 5)
+
+        print("Waiters don't give up and generate the page themselves when it takes longer than they wait")
+        conn.delete('cache:' + hash_request(url), 'cache:' + hash_request(url) + ':meta')
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            cache_request_single_flight(conn, url, callback, wait=.05))) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(set(map(to_bytes, results)), set([to_bytes("content for " + url)]))
+
+    def test_cache_rows_batched(self):
+        conn = self.conn
+        global QUIT
+
+        print("Let's schedule caching of a few items every 2 seconds")
+        for i in range(10):
+            schedule_row_cache(conn, 'item%s'%i, 2)
+        schedule_row_cache(conn, 'itemX', -1)
+
+        print("We'll start a couple of caching threads that split the work")
+        threads = [threading.Thread(target=cache_rows_batched, args=(conn, 4)) for i in range(2)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        time.sleep(1)
+        r = conn.mget(['inv:item%s'%i for i in range(10)])
+        print("Our cached data looks like:", r[0])
+        self.assertTrue(all(r))
+        self.assertFalse(conn.zscore('schedule:', 'itemX'))
+
+        time.sleep(2)
+        r2 = conn.mget(['inv:item%s'%i for i in range(10)])
+        print("Notice that the data has changed:", r2[0])
+        self.assertTrue(all(a != b for a, b in zip(r, r2)))
+
+        QUIT = True
+        for t in threads:
+            t.join()
+
+    def test_row_codecs(self):
+        conn = self.conn
+        row = Inventory.get('itemX').to_dict()
+
+        print("Every codec should get our row back")
+        for codec in CODEC_TAGS:
+            if CODEC_TAGS[codec] not in CODECS:
+                continue
+            for compress_over in (None, 0):
+                self.assertEqual(decode_row(encode_row(row, codec, compress_over)), row)
+
+        print("Readers can decode rows no matter how they were written")
+        self.assertEqual(json.loads(encode_row(row)), row)
+        conn.set('inv:itemX', json.dumps(row))
+        conn.set('inv:itemY', encode_row(row, 'struct'))
+        self.assertEqual(get_cached_rows(conn, ['itemX', 'itemY', 'itemZ']), [row, row, None])
+
+        print("Let's compare the codecs")
+        r = benchmark_row_codecs([Inventory.get('item%s'%i).to_dict() for i in range(1000)])
+        self.assertTrue(r['struct']['bytes'] < r['json']['bytes'])
+
+    def test_decayed_views(self):
+        conn = self.conn
+        token = str(uuid.uuid4())
+
+        print("Let's view some items, one of them more than the others")
+        now = time.time()
+        record_views(conn, ['itemA', 'itemB', 'itemB'], now - 2 * VIEW_HALF_LIFE)
+        update_token_decayed(conn, token, 'username', 'itemA')
+        popular = get_popular_items(conn)
+        print("The most popular items are:", popular)
+        self.assertEqual(popular[0][0], b'itemA')
+        self.assertAlmostEqual(popular[0][1], 1.25, 2)
+        self.assertAlmostEqual(popular[1][1], .5, 2)
+        self.assertTrue(can_cache_decayed(conn, 'http://test.com/?item=itemB'))
+        self.assertFalse(can_cache_decayed(conn, 'http://test.com/?item=itemC'))
+
+        print("Renormalizing doesn't change the decayed counts")
+        self.assertTrue(renormalize_popular(conn, chunk=1, limit=1))
+        popular = get_popular_items(conn)
+        print("The most popular items are now:", popular)
+        self.assertEqual(len(popular), 1)
+        self.assertAlmostEqual(popular[0][1], 1.25, 2)
+        self.assertTrue(float(conn.get('popular:epoch')) > now - 1)
+
+    def test_cart_store(self):
+        conn = self.conn
+        anon = str(uuid.uuid4())
+        token = str(uuid.uuid4())
+
+        print("Let's add and remove a few items at once")
+        self.assertTrue(update_cart(conn, anon, {'itemA': 2, 'itemB': 1}))
+        self.assertFalse(update_cart(conn, anon, {'itemA': -1, 'itemB': -2}))
+        self.assertTrue(update_cart(conn, anon, {'itemA': -1, 'itemB': -1}))
+        self.assertEqual(get_cart(conn, anon), {b'itemA': b'1'})
+
+        print("Then log in, and merge our anonymous cart")
+        update_token(conn, token, 'username')
+        update_cart(conn, token, {'itemA': 1, 'itemC': 3})
+        self.assertEqual(merge_carts(conn, anon, token), 1)
+        self.assertEqual(get_cart(conn, token), {b'itemA': b'2', b'itemC': b'3'})
+        self.assertFalse(conn.exists('cart:' + anon))
+
+        print("Idle carts are snapshotted, and restored when we need them")
+        self.assertEqual(snapshot_idle_carts(conn, idle=0), 1)
+        self.assertFalse(conn.exists('cart:' + token))
+        print("Our snapshot is:", conn.hget(CART_SNAPSHOTS, token))
+        self.assertTrue(update_cart(conn, token, {'itemC': -3}))
+        self.assertEqual(get_cart(conn, token), {b'itemA': b'2'})
+        self.assertFalse(conn.hexists(CART_SNAPSHOTS, token))
+
     # We aren't going to bother with the top 10k requests are cached, as
     # we already tested it as part of the cached requests test.
 
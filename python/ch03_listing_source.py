@@ -1,10 +1,18 @@
 
+import asyncio
+from collections import deque
+import queue
 import threading
 import time
 import unittest
 
 import redis
 
+
+def to_str(x):
+    return x.decode() if isinstance(x, bytes) else x
+
+
 ONE_WEEK_IN_SECONDS = 7 * 86400
 VOTE_SCORE = 432
 ARTICLES_PER_PAGE = 25
@@ -324,6 +332,192 @@ def run_pubsub():
         if count == 5:
             break
 
+# <start id="pubsub-hub"/>
+class HubConsumer(object):
+    def __init__(self, callback=None, maxsize=1000, policy='drop-oldest',
+                 loop=None, timeout=1):
+        self.callback = callback                                    #A
+        self.policy = policy
+        self.loop = loop
+        self.timeout = timeout
+        self.dropped = 0
+        self.errors = 0
+        if loop:
+            self.queue = asyncio.Queue(maxsize)                     #B
+        else:
+            self.queue = queue.Queue(maxsize)
+
+    def deliver(self, message):
+        if self.callback:
+            self.callback(message)
+        elif self.loop:
+            self.loop.call_soon_threadsafe(self._put, message, False)#B
+        else:
+            self._put(message, self.policy == 'block')
+
+    def _put(self, message, block):
+        while True:
+            try:
+                if block:
+                    self.queue.put(message, timeout=self.timeout)   #C
+                else:
+                    self.queue.put_nowait(message)
+                return
+            except (queue.Full, asyncio.QueueFull):
+                if self.policy != 'drop-oldest':                    #D
+                    self.dropped += 1                               #D
+                    return
+                try:
+                    self.queue.get_nowait()                         #E
+                    self.dropped += 1                               #E
+                except (queue.Empty, asyncio.QueueEmpty):
+                    pass
+
+    def get(self, timeout=None):
+        if self.loop:
+            return self._get_async(timeout)                         #B
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    async def _get_async(self, timeout):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def depth(self):
+        return self.queue.qsize()
+
+class PubSubHub(object):
+    def __init__(self, conn, backoff=.1, max_backoff=5):
+        self.conn = conn
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.consumers = {}                                         #F
+        self.counts = {}
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.quit = False
+        self.thread = None
+
+    def subscribe(self, channel, callback=None, pattern=False, **kwargs):
+        consumer = HubConsumer(callback, **kwargs)
+        key = (pattern, channel)
+        with self.lock:
+            if key not in self.consumers:
+                self.consumers[key] = []
+                self.pending.append(('psubscribe' if pattern else 'subscribe', channel))#G
+            self.consumers[key].append(consumer)
+        return consumer
+
+    def psubscribe(self, pattern, callback=None, **kwargs):
+        return self.subscribe(pattern, callback, True, **kwargs)
+
+    def unsubscribe(self, consumer):
+        with self.lock:
+            for (pattern, channel), consumers in list(self.consumers.items()):
+                if consumer in consumers:
+                    consumers.remove(consumer)
+                    if not consumers:                               #H
+                        del self.consumers[(pattern, channel)]      #H
+                        self.pending.append(                        #H
+                            ('punsubscribe' if pattern else 'unsubscribe', channel))
+
+    def _connect(self):
+        pubsub = self.conn.pubsub()
+        with self.lock:
+            self.pending.clear()
+            for pattern, channel in self.consumers:                 #I
+                if pattern:                                         #I
+                    pubsub.psubscribe(channel)                      #I
+                else:                                               #I
+                    pubsub.subscribe(channel)                       #I
+        return pubsub
+
+    def _dispatch(self, message):
+        if message['type'] == 'pmessage':
+            key = (True, to_str(message['pattern']))
+        elif message['type'] == 'message':
+            key = (False, to_str(message['channel']))
+        else:
+            return
+        with self.lock:
+            consumers = list(self.consumers.get(key, ()))
+            self.counts[key] = self.counts.get(key, 0) + 1
+        for consumer in consumers:                                  #J
+            try:
+                consumer.deliver(message)                           #J
+            except Exception:
+                consumer.errors += 1                                #K
+
+    def _run(self):
+        pubsub = None
+        backoff = self.backoff
+        while not self.quit:
+            try:
+                if pubsub is None:
+                    pubsub = self._connect()
+                    backoff = self.backoff
+                with self.lock:
+                    pending, self.pending = self.pending, deque()
+                for command, channel in pending:                    #G
+                    getattr(pubsub, command)(channel)               #G
+                if not pubsub.subscribed:
+                    time.sleep(.01)
+                    continue
+                message = pubsub.get_message(timeout=.05)
+                if message:
+                    self._dispatch(message)
+            except redis.exceptions.ConnectionError:
+                if pubsub is not None:
+                    pubsub.reset()
+                pubsub = None                                       #L
+                time.sleep(backoff)                                 #L
+                backoff = min(backoff * 2, self.max_backoff)        #L
+        if pubsub is not None:
+            pubsub.close()
+
+    def start(self):
+        self.quit = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.quit = True
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        elapsed = max(time.time() - self.started, .001)
+        with self.lock:
+            return dict(((pattern, channel), {                      #M
+                'messages': self.counts.get((pattern, channel), 0),
+                'rate': self.counts.get((pattern, channel), 0) / elapsed,
+                'depths': [c.depth() for c in consumers if not c.callback],
+                'dropped': sum(c.dropped for c in consumers),
+                'errors': sum(c.errors for c in consumers),
+            }) for (pattern, channel), consumers in self.consumers.items())
+# <end id="pubsub-hub"/>
+#A Consumers can either have their messages delivered to a callback, or to a bounded queue
+#B Asyncio consumers get an asyncio.Queue, which we can only touch from the event loop's thread, so their get() returns a coroutine to await there
+#C With the 'block' policy, a full queue applies backpressure to the hub, but only for a limited time
+#D With the 'drop-newest' policy (or when blocking timed out), we drop the new message
+#E With the 'drop-oldest' policy, we drop the oldest message to make room for the new one
+#F All of our local consumers, keyed by whether they are a pattern subscription and the channel or pattern
+#G Subscription changes are queued up and sent by the hub thread, as PubSub objects aren't safe to share between threads
+#H We only unsubscribe from Redis when the last local consumer goes away
+#I When (re)connecting, subscribe to all of the channels and patterns that we have consumers for
+#J Every local consumer of the channel or pattern gets the message
+#K A consumer whose callback raises only loses that message, instead of stopping the hub for every other consumer
+#L If we lost our connection, wait a bit longer each time before reconnecting and resubscribing
+#M Report the message count and rate, queue depths, dropped messages, and callback errors for each channel and pattern, keyed like our consumers so a pattern can't hide a channel with the same name
+#END
+
 '''
 # <start id="pubsub-calls-1"/>
 >>> def publisher(n):
@@ -586,3 +780,125 @@ def add_to_cart(conn, session, item, count):
 #C We can't manipulate LISTs and set their expiration at the same time, so we must do it later
 #D We also can't manipulate HASHes and set their expiration times, so we again do it later
 #END
+
+#--------------- Below this line are helpers to test the code ----------------
+
+class TestCh03(unittest.TestCase):
+    def setUp(self):
+        import redis
+        self.conn = redis.Redis(host="redis-in-action-redis", db=15)
+        self.hub = PubSubHub(self.conn, backoff=.01)
+
+    def tearDown(self):
+        self.hub.stop()
+        del self.hub
+        del self.conn
+        print()
+        print()
+
+    def publish(self, channel, message, receivers=1):
+        end = time.time() + 5
+        while self.conn.publish(channel, message) < receivers:
+            self.assertTrue(time.time() < end)
+            time.sleep(.01)
+
+    def test_pubsub_hub(self):
+        hub = self.hub
+
+        print("Every local consumer of a channel or pattern gets each message...")
+        seen = []
+        first = hub.subscribe('hub-channel')
+        second = hub.subscribe('hub-channel')
+        hub.subscribe('hub-channel', seen.append)
+        pattern = hub.psubscribe('hub-channel')
+        wildcard = hub.psubscribe('hub-*')
+        hub.start()
+        self.publish('hub-channel', 'hello', 3)
+        for consumer in (first, second):
+            self.assertEqual(consumer.get(timeout=1)['data'], b'hello')
+        self.assertEqual(wildcard.get(timeout=1)['pattern'], b'hub-*')
+        end = time.time() + 1
+        while not seen and time.time() < end:
+            time.sleep(.01)
+        self.assertEqual(seen[0]['data'], b'hello')
+
+        print("...and stats are kept separately for channels and patterns with the same name")
+        stats = hub.stats()
+        self.assertEqual(stats[False, 'hub-channel']['messages'], 1)
+        self.assertEqual(stats[False, 'hub-channel']['depths'], [0, 0])
+        self.assertEqual(stats[True, 'hub-channel']['messages'], 1)
+        self.assertEqual(stats[True, 'hub-channel']['depths'], [1])
+        self.assertEqual(stats[True, 'hub-*']['messages'], 1)
+        self.assertEqual(pattern.get(timeout=1)['pattern'], b'hub-channel')
+        hub.unsubscribe(pattern)
+        self.assertNotIn((True, 'hub-channel'), hub.stats())
+
+        print("A callback that raises doesn't stop delivery to anyone else")
+        def broken(message):
+            raise ValueError(message)
+        hub.subscribe('hub-broken', broken)
+        other = hub.subscribe('hub-other')
+        self.publish('hub-broken', 'oops', 2)
+        self.publish('hub-other', 'still here', 2)
+        self.assertEqual(other.get(timeout=1)['data'], b'still here')
+        self.assertEqual(hub.stats()[False, 'hub-broken']['errors'], 1)
+        self.assertTrue(hub.thread.is_alive())
+
+        print("Full queues drop messages according to their policy")
+        messages = [{'data': i} for i in range(5)]
+        oldest = HubConsumer(maxsize=2)
+        newest = HubConsumer(maxsize=2, policy='drop-newest')
+        block = HubConsumer(maxsize=2, policy='block', timeout=.01)
+        for consumer in (oldest, newest, block):
+            for message in messages:
+                consumer.deliver(message)
+            self.assertEqual(consumer.dropped, 3)
+            self.assertEqual(consumer.depth(), 2)
+        self.assertEqual([oldest.get()['data'], oldest.get()['data']], [3, 4])
+        self.assertEqual([newest.get()['data'], newest.get()['data']], [0, 1])
+        self.assertEqual([block.get()['data'], block.get()['data']], [0, 1])
+
+        print("Asyncio consumers await their messages on the event loop")
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            waiting = hub.subscribe('async-channel', loop=loop)
+            self.publish('async-channel', 'async')
+            message = loop.run_until_complete(waiting.get(timeout=1))
+            self.assertEqual(message['data'], b'async')
+            self.assertEqual(loop.run_until_complete(waiting.get(timeout=.01)), None)
+            hub.unsubscribe(waiting)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_pubsub_hub_resubscribe(self):
+        hub = self.hub
+        failures = [1]
+        connect = hub._connect
+        def flaky_connect():
+            pubsub = connect()
+            get_message = pubsub.get_message
+            def flaky_get_message(*args, **kwargs):
+                if failures:
+                    failures.pop()
+                    raise redis.exceptions.ConnectionError()
+                return get_message(*args, **kwargs)
+            pubsub.get_message = flaky_get_message
+            return pubsub
+        hub._connect = flaky_connect
+
+        print("After losing its connection, the hub resubscribes to everything")
+        consumer = hub.subscribe('hub-channel')
+        wildcard = hub.psubscribe('hub-*')
+        hub.start()
+        end = time.time() + 5
+        while failures and time.time() < end:
+            time.sleep(.01)
+        self.assertFalse(failures)
+        self.publish('hub-channel', 'again', 2)
+        self.assertEqual(consumer.get(timeout=1)['data'], b'again')
+        self.assertEqual(wildcard.get(timeout=1)['data'], b'again')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,14 @@
 
+import binascii
+import bisect
+from collections import deque
+import heapq
+import itertools
+import mmap
+import multiprocessing
 import os
+import random
+import threading
 import time
 import unittest
 import uuid
@@ -77,6 +86,142 @@ def process_logs(conn, path, callback):                     #K
 #L The enumerate function iterates over a sequence (in this case lines from a file), and produces pairs consisting of a numeric sequence starting from 0, and the original data
 #END
 
+# <start id="process-logs-parallel"/>
+LOG_BATCH_SIZE = 2**20
+
+def log_batches(filename, start=0, batch_size=LOG_BATCH_SIZE):
+    with open(filename, 'rb') as inp:
+        try:
+            data = mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ) #A
+        except (ValueError, OSError):
+            inp.seek(start)                                         #B
+            for batch in read_log_batches(inp, start, batch_size):  #B
+                yield batch                                         #B
+            return
+        try:
+            size = len(data)
+            while start < size:
+                end = min(start + batch_size, size)
+                if end < size:
+                    newline = data.rfind(b'\n', start, end)         #C
+                    if newline == -1:                               #C
+                        newline = data.find(b'\n', end)             #C
+                    end = newline + 1 if newline != -1 else size    #C
+                yield start, end, data[start:end]                   #D
+                start = end
+        finally:
+            data.close()
+
+log_connection = None
+
+def init_log_worker(redis_kwargs):
+    global log_connection
+    log_connection = redis.Redis(**redis_kwargs)                    #E
+
+def process_log_batch(callback, fname, start, end, data):
+    marker = '%s:%s'%(fname, start)
+    if log_connection.sismember('progress:done', marker):           #F
+        return end
+    pipe = log_connection.pipeline(True)
+    for line in data.splitlines(True):
+        callback(pipe, line)                                        #G
+    pipe.sadd('progress:done', marker)                              #H
+    pipe.execute()                                                  #H
+    return end
+
+def process_logs_parallel(conn, path, callback, processes=None,
+                          batch_size=LOG_BATCH_SIZE, redis_kwargs=None,
+                          pool_class=multiprocessing.Pool):
+    current_file, offset, resumed_size = conn.mget(
+        'progress:file', 'progress:position', 'progress:batch-size')
+    current_file = current_file and current_file.decode()
+    if resumed_size and int(resumed_size) != batch_size and \
+            conn.scard('progress:done'):                            #I
+        raise ValueError("resuming with batch_size=%s, but the last run "
+            "used %s"%(batch_size, int(resumed_size)))
+    conn.set('progress:batch-size', batch_size)                     #I
+    if redis_kwargs is None:
+        kwargs = conn.connection_pool.connection_kwargs             #J
+        redis_kwargs = dict((k, kwargs[k])                          #J
+            for k in ('host', 'port', 'db', 'password') if k in kwargs)#J
+    pool = pool_class(processes, init_log_worker, (redis_kwargs,))  #K
+    window = (processes or os.cpu_count() or 1) * 2                 #L
+    pipe = conn.pipeline(True)
+
+    def checkpoint(fname, start, result):
+        pipe.mset({                                                 #M
+            'progress:file': fname,                                 #M
+            'progress:position': result.get()                       #M
+        })
+        pipe.srem('progress:done', '%s:%s'%(fname, start))          #M
+        pipe.execute()
+
+    try:
+        for fname in sorted(os.listdir(path)):
+            if current_file and fname < current_file:
+                continue
+            start = int(offset) if fname == current_file else 0
+            current_file = None
+
+            pending = deque()
+            for bstart, bend, data in log_batches(
+                    os.path.join(path, fname), start, batch_size):
+                pending.append((bstart, pool.apply_async(
+                    process_log_batch, (callback, fname, bstart, bend, data))))
+                if len(pending) >= window:
+                    checkpoint(fname, *pending.popleft())           #N
+            while pending:
+                checkpoint(fname, *pending.popleft())               #N
+    finally:
+        pool.close()
+        pool.join()
+
+def read_log_batches(inp, start, batch_size):
+    data = b''
+    eof = False
+    while True:
+        while len(data) <= batch_size and not eof:                  #O
+            chunk = inp.read(batch_size + 1 - len(data))            #O
+            eof = not chunk                                         #O
+            data += chunk                                           #O
+        end = len(data)
+        if end > batch_size:
+            newline = data.rfind(b'\n', 0, batch_size)              #C
+            checked = batch_size
+            while newline == -1:
+                newline = data.find(b'\n', checked)                 #P
+                if newline != -1 or eof:                            #P
+                    break                                           #P
+                checked = len(data)                                 #P
+                chunk = inp.read(batch_size)                        #P
+                eof = not chunk                                     #P
+                data += chunk                                       #P
+            if newline != -1:
+                end = newline + 1
+        if not end:
+            return
+        yield start, start + end, data[:end]                        #D
+        start += end
+        data = data[end:]
+# <end id="process-logs-parallel"/>
+#A Map the file into memory where possible, so that batches are sliced out of the file without reading it line by line
+#B Otherwise read the file a batch at a time
+#C Batches end on a line boundary, so no line is ever split across batches, and batch boundaries only depend on where we started
+#D Only the batch as a whole is copied out of the file for the worker; lines are split in the worker
+#E Each worker process gets its own connection, and so its own pipelines
+#F If we crashed after this batch was applied, but before it was checkpointed, don't apply it again
+#G The callback is the same as for process_logs(), but it must be a module-level function so that it can be sent to the worker processes
+#H Record that the batch was applied in the same transaction as its changes
+#I The markers of batches that were in flight only match if we split the file into the same batches, so don't resume with a different batch size, and record it before any markers are written
+#J By default, workers connect to the same server as we do
+#K Passing multiprocessing.dummy.Pool runs the workers as threads in this process instead
+#L Limit the number of batches in flight, so that we don't read whole files into memory
+#M Record our progress, and clean up the batch marker, which is no longer needed once the checkpoint is past the batch
+#N Batches are checkpointed in order, so the checkpoint only moves past a batch once every earlier batch has been applied
+#O Read until we have more than a full batch (or the rest of the file), so we know whether the batch ends at the end of the file
+#P A line longer than a batch is read until its newline, just like when the file is mapped
+#END
+
 # <start id="wait-for-sync"/>
 def wait_for_sync(mconn, sconn):
     identifier = str(uuid.uuid4())
@@ -105,6 +250,116 @@ def wait_for_sync(mconn, sconn):
 #F Clean up our status and clean out older entries that may have been left there
 #END
 
+# <start id="durable-writer"/>
+LATENCY_BUCKETS = [.0001, .0002, .0005, .001, .002, .005, .01, .02, .05,   #A
+                   .1, .2, .5, 1, 2, 5, float('inf')]                       #A
+
+class DurableWriter(object):
+    def __init__(self, conn, replicas=()):
+        pool = conn.connection_pool
+        self.conn = redis.Redis(connection_pool=                    #B
+            redis.BlockingConnectionPool(max_connections=1,         #B
+                connection_class=pool.connection_class,             #B
+                **pool.connection_kwargs))                          #B
+        self.replicas = list(replicas)                              #C
+        self.use_wait = {'WAIT': True, 'WAITAOF': True}             #P
+        self.histograms = {}
+
+    def write(self, callback):
+        identifier = str(uuid.uuid4())
+        now = time.time()
+        pipe = self.conn.pipeline(True)
+        callback(pipe)                                              #D
+        pipe.zadd('sync:wait', {identifier: now})                   #E
+        pipe.zremrangebyscore('sync:wait', 0, now - 900)            #E
+        pipe.execute()
+        return identifier
+
+    def wait_replicated(self, token, n_replicas=1, timeout=1,
+                        fsync=False, site='default'):
+        start = time.time()
+        acked = None
+        command = 'WAITAOF' if fsync else 'WAIT'
+        milliseconds = max(int(timeout * 1000), 1)                  #Q
+        if self.use_wait[command]:
+            try:
+                if fsync:
+                    acked = self.conn.execute_command(              #F
+                        'WAITAOF', 0, n_replicas, milliseconds)[1]
+                else:
+                    acked = self.conn.execute_command(              #G
+                        'WAIT', n_replicas, milliseconds)
+            except redis.exceptions.ResponseError:
+                self.use_wait[command] = False                      #H
+        if acked is None:
+            acked = self._poll(token, n_replicas, start + timeout, fsync)
+        self._record(site, time.time() - start)
+        return acked >= n_replicas
+
+    def write_batch(self, callbacks, n_replicas=1, timeout=1,
+                    fsync=False, site='default'):
+        tokens = [self.write(callback) for callback in callbacks]
+        if tokens and self.wait_replicated(                         #I
+                tokens[-1], n_replicas, timeout, fsync, site):      #I
+            return tokens
+        return None
+
+    def _poll(self, token, n_replicas, deadline, fsync):
+        waiting = list(self.replicas)
+        acked = 0
+        delay = .001
+        while waiting and acked < n_replicas:
+            for sconn in list(waiting):
+                if sconn.zscore('sync:wait', token) is None:        #J
+                    continue
+                if fsync and sconn.info().get('aof_pending_bio_fsync', 0):#K
+                    continue
+                waiting.remove(sconn)
+                acked += 1
+            if acked >= n_replicas or time.time() >= deadline:
+                break
+            time.sleep(min(delay, max(deadline - time.time(), 0)))  #L
+            delay = min(delay * 2, .1)                              #L
+        return acked
+
+    def _record(self, site, latency):
+        histogram = self.histograms.setdefault(site, [0] * len(LATENCY_BUCKETS))
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1 #M
+
+    def latency_histograms(self):
+        return dict((site, list(zip(LATENCY_BUCKETS, counts)))      #N
+            for site, counts in self.histograms.items())
+
+    def latency_percentile(self, site, percentile):
+        counts = self.histograms.get(site)
+        if not counts:
+            return None
+        target = sum(counts) * percentile / 100.
+        seen = 0
+        for bucket, count in zip(LATENCY_BUCKETS, counts):
+            seen += count
+            if seen >= target:
+                return bucket                                       #O
+# <end id="durable-writer"/>
+#A Latency histogram bucket upper bounds, in seconds
+#B WAIT only knows about writes made on the same connection, so our pool has exactly one connection, which our pipelines and WAIT share
+#C Replica connections are only needed for Redis versions without WAIT
+#D The callback adds its writes to our transaction
+#E Add a sync token in the same transaction, just like wait_for_sync(), and clean out old tokens
+#F Wait for replicas to have written the data to disk, on Redis 7.2 and later
+#G Wait for replicas to have received the data
+#H Our Redis doesn't support this command, so fall back to polling replicas for the token
+#I Many writes can share one wait, because waiting covers every earlier write on the connection
+#J The replica hasn't received the token yet
+#K Like wait_for_sync(), check to see if the data is known to be on disk
+#L Back off exponentially, instead of polling every millisecond
+#M Count the latency in the first bucket that is large enough
+#N Export histograms as (bucket upper bound, count) pairs for each call site
+#O Approximate the percentile with the upper bound of its bucket
+#P WAITAOF was added long after WAIT, so we keep track of which of them our Redis supports separately
+#Q A timeout of 0 would wait forever, so always wait at least 1 millisecond
+#END
+
 '''
 # <start id="master-failover"/>
 user@vpn-master ~:$ ssh root@machine-b.vpn                          #A
@@ -205,6 +460,411 @@ def purchase_item(conn, buyerid, itemid, sellerid, lprice):
 #D Retry if the buyer's account or the market changed
 #END
 
+# <start id="script-load"/>
+def script_load(script):
+    sha = [None]
+    def call(conn, keys=[], args=[], force_eval=False):
+        if not force_eval:
+            if not sha[0]:
+                sha[0] = conn.execute_command(
+                    "SCRIPT", "LOAD", script, parse="LOAD")
+
+            try:
+                return conn.execute_command(
+                    "EVALSHA", sha[0], len(keys), *(keys+args))
+
+            except redis.exceptions.ResponseError as msg:
+                if not msg.args[0].startswith("NOSCRIPT"):
+                    raise
+
+        return conn.execute_command(
+            "EVAL", script, len(keys), *(keys+args))
+
+    return call
+# <end id="script-load"/>
+
+def to_str(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+# <start id="scripted-market"/>
+PURCHASED = 'purchased'
+NOT_LISTED = 'not-listed'
+PRICE_CHANGED = 'price-changed'
+NO_ACCOUNT = 'no-account'
+INSUFFICIENT_FUNDS = 'insufficient-funds'
+LISTED = 'listed'
+NOT_IN_INVENTORY = 'not-in-inventory'
+BAD_PRICE = 'bad-price'
+
+def purchase_item_scripted(conn, buyerid, itemid, sellerid, lprice=None):
+    buyer = "users:%s"%buyerid
+    seller = "users:%s"%sellerid
+    item = "%s.%s"%(itemid, sellerid)
+    inventory = "inventory:%s"%buyerid
+    return to_str(purchase_item_lua(conn,                       #A
+        ['market:', buyer, seller, inventory],                  #A
+        [item, itemid, '' if lprice is None else lprice]))      #A
+
+purchase_item_lua = script_load('''
+local price = redis.call('zscore', KEYS[1], ARGV[1])
+if not price then
+    return 'not-listed'                                         --B
+end
+price = tonumber(price)
+if ARGV[3] ~= '' and price ~= tonumber(ARGV[3]) then
+    return 'price-changed'                                      --C
+end
+if price % 1 ~= 0 then
+    return 'bad-price'                                          --D
+end
+local funds = tonumber(redis.call('hget', KEYS[2], 'funds'))
+if not funds then
+    return 'no-account'                                         --E
+end
+if funds < price then
+    return 'insufficient-funds'                                 --F
+end
+redis.call('hincrby', KEYS[3], 'funds', price)                  --G
+redis.call('hincrby', KEYS[2], 'funds', -price)                 --G
+redis.call('sadd', KEYS[4], ARGV[2])                            --G
+redis.call('zrem', KEYS[1], ARGV[1])                            --G
+return 'purchased'
+''')
+
+def list_items_scripted(conn, sellerid, prices):
+    prices = list(prices.items())
+    args = [sellerid]
+    for itemid, price in prices:
+        args.extend([itemid, price])
+    results = list_items_lua(conn,                              #H
+        ["inventory:%s"%sellerid, 'market:'], args)             #H
+    return dict((itemid, to_str(result))
+        for (itemid, price), result in zip(prices, results))
+
+list_items_lua = script_load('''
+local results = {}
+for i = 2, #ARGV, 2 do
+    local price = tonumber(ARGV[i+1])
+    if not price or price < 0 or price % 1 ~= 0 then
+        results[#results+1] = 'bad-price'                       --I
+    elseif redis.call('srem', KEYS[1], ARGV[i]) == 1 then       --J
+        redis.call('zadd', KEYS[2], price, ARGV[i] .. '.' .. ARGV[1])
+        results[#results+1] = 'listed'
+    else
+        results[#results+1] = 'not-in-inventory'
+    end
+end
+return results
+''')
+# <end id="scripted-market"/>
+#A Prepare all of the keys and arguments for the Lua script, an empty price will buy at whatever the listed price is
+#B The item was already sold or was never listed
+#C The seller changed the price since the buyer saw it
+#D Funds are whole numbers, so an item listed at a fractional price some other way can't be bought
+#E The buyer doesn't have an account
+#F The buyer can't afford the item
+#G Transfer funds from the buyer to the seller, and transfer the item to the buyer, without any WATCH retries
+#H List many items from the same seller with one call
+#I Don't list items with invalid prices; funds are whole numbers, so prices must be too
+#J Removing the item from the inventory tells us whether the seller had it
+#END
+
+# <start id="purchase-item-with-lock"/>
+def acquire_lock(conn, lockname, acquire_timeout=10):
+    identifier = str(uuid.uuid4())
+
+    end = time.time() + acquire_timeout
+    while time.time() < end:
+        if conn.setnx('lock:' + lockname, identifier):
+            return identifier
+
+        time.sleep(.001)
+
+    return False
+
+def release_lock(conn, lockname, identifier):
+    pipe = conn.pipeline(True)
+    lockname = 'lock:' + lockname
+    if isinstance(identifier, str):
+        identifier = identifier.encode()
+
+    while True:
+        try:
+            pipe.watch(lockname)
+            if pipe.get(lockname) == identifier:
+                pipe.multi()
+                pipe.delete(lockname)
+                pipe.execute()
+                return True
+
+            pipe.unwatch()
+            break
+
+        except redis.exceptions.WatchError:
+            pass
+
+    return False
+
+def purchase_item_with_lock(conn, buyerid, itemid, sellerid):
+    buyer = "users:%s" % buyerid
+    seller = "users:%s" % sellerid
+    item = "%s.%s" % (itemid, sellerid)
+    inventory = "inventory:%s" % buyerid
+
+    locked = acquire_lock(conn, 'market:')
+    if not locked:
+        return False
+
+    pipe = conn.pipeline(True)
+    try:
+        pipe.zscore("market:", item)
+        pipe.hget(buyer, 'funds')
+        price, funds = pipe.execute()
+        if price is None or price > int(funds):
+            return None
+
+        pipe.hincrby(seller, 'funds', int(price))
+        pipe.hincrby(buyer, 'funds', int(-price))
+        pipe.sadd(inventory, itemid)
+        pipe.zrem("market:", item)
+        pipe.execute()
+        return True
+    finally:
+        release_lock(conn, 'market:', locked)
+# <end id="purchase-item-with-lock"/>
+
+# <start id="purchase-item-lua"/>
+def purchase_item_lua_simple(conn, buyerid, itemid, sellerid):
+    buyer = "users:%s" % buyerid
+    seller = "users:%s" % sellerid
+    item = "%s.%s"%(itemid, sellerid)
+    inventory = "inventory:%s" % buyerid
+
+    return purchase_item_simple_lua(conn,
+        ['market:', buyer, seller, inventory], [item, itemid])
+
+purchase_item_simple_lua = script_load('''
+local price = tonumber(redis.call('zscore', KEYS[1], ARGV[1]))
+local funds = tonumber(redis.call('hget', KEYS[2], 'funds'))
+
+if price and price % 1 == 0 and funds and funds >= price then
+    redis.call('hincrby', KEYS[3], 'funds', price)
+    redis.call('hincrby', KEYS[2], 'funds', -price)
+    redis.call('sadd', KEYS[4], ARGV[2])
+    redis.call('zrem', KEYS[1], ARGV[1])
+    return true
+end
+''')
+# <end id="purchase-item-lua"/>
+
+# <start id="purchase-contention-benchmark"/>
+def benchmark_purchase_contention(conn, buyers=(1, 2, 4, 8, 16, 32, 64),
+                                  items=1000, sellers=10):
+    variants = [                                                #A
+        ('watch', lambda c, b, i, s, p: purchase_item(c, b, i, s, p)),
+        ('lock', lambda c, b, i, s, p: purchase_item_with_lock(c, b, i, s)),
+        ('lua', lambda c, b, i, s, p: purchase_item_lua_simple(c, b, i, s)),
+        ('scripted', purchase_item_scripted),
+    ]
+    results = []
+    for count in buyers:
+        for name, purchase in variants:
+            conn.delete('market:', 'lock:market:')
+            listings = []
+            for seller in range(sellers):                       #B
+                prices = dict(('item%s'%i, i % 100 + 1)         #B
+                    for i in range(seller, items, sellers))     #B
+                conn.sadd('inventory:seller%s'%seller, *prices) #B
+                list_items_scripted(conn, 'seller%s'%seller, prices)
+                listings.extend(('seller%s'%seller, itemid, price)
+                    for itemid, price in prices.items())
+            random.shuffle(listings)
+            for buyer in range(count):
+                conn.hset('users:buyer%s'%buyer, 'funds', items * 100)
+
+            attempts = [0]
+            def buy(buyer):
+                bconn = redis.Redis(connection_pool=conn.connection_pool)
+                start = random.randrange(len(listings))
+                for i in range(len(listings)):                  #C
+                    seller, itemid, price = listings[(start + i) % len(listings)]
+                    attempts[0] += 1
+                    purchase(bconn, 'buyer%s'%buyer, itemid, seller, price)
+
+            threads = [threading.Thread(target=buy, args=(buyer,))
+                for buyer in range(count)]
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            delta = time.time() - start
+            sold = items - conn.zcard('market:')                #D
+            results.append((name, count, sold / delta, attempts[0] / delta))
+            print(name, count, sold, delta, sold / delta, attempts[0] / delta)
+
+            for buyer in range(count):                          #E
+                conn.delete('users:buyer%s'%buyer, 'inventory:buyer%s'%buyer)
+            for seller in range(sellers):
+                conn.delete('users:seller%s'%seller, 'inventory:seller%s'%seller)
+    conn.delete('market:')
+    return results
+# <end id="purchase-contention-benchmark"/>
+#A Compare the WATCH, lock, and simple Lua versions with our scripted engine, all called the same way
+#B Give each seller some items and list them in bulk
+#C Every buyer tries to buy every item, starting from a random position, so popular items see contention
+#D Count how many items were actually sold
+#E Clean up after this round
+#END
+
+# <start id="sharded-market"/>
+MARKET_SHARDS = 16
+
+def market_shard(itemid, shards=MARKET_SHARDS):
+    itemid = str(itemid).encode()
+    return 'market:%s'%(binascii.crc32(itemid) % shards)          #A
+
+def list_items_sharded(conn, sellerid, prices, shards=MARKET_SHARDS):
+    by_shard = {}
+    for itemid, price in prices.items():                            #B
+        by_shard.setdefault(market_shard(itemid, shards), {})[itemid] = price
+    results = {}
+    for shard, shard_prices in by_shard.items():
+        items = list(shard_prices.items())
+        args = [sellerid]
+        for itemid, price in items:
+            args.extend([itemid, price])
+        for (itemid, price), result in zip(items, list_items_lua(conn,  #C
+                ["inventory:%s"%sellerid, shard], args)):               #C
+            results[itemid] = to_str(result)
+    return results
+
+def purchase_item_sharded(conn, buyerid, itemid, sellerid, lprice=None,
+                          shards=MARKET_SHARDS):
+    return to_str(purchase_item_lua(conn,                           #D
+        [market_shard(itemid, shards), "users:%s"%buyerid,          #D
+         "users:%s"%sellerid, "inventory:%s"%buyerid],              #D
+        ["%s.%s"%(itemid, sellerid), itemid,
+         '' if lprice is None else lprice]))
+
+def purchase_item_with_shard_lock(conn, buyerid, itemid, sellerid,
+                                  lprice=None, shards=MARKET_SHARDS):
+    market = market_shard(itemid, shards)
+    buyer = "users:%s" % buyerid
+    seller = "users:%s" % sellerid
+    item = "%s.%s" % (itemid, sellerid)
+
+    locked = acquire_lock(conn, market)                             #E
+    if not locked:
+        return False
+
+    pipe = conn.pipeline(True)
+    try:
+        pipe.zscore(market, item)
+        pipe.hget(buyer, 'funds')
+        price, funds = pipe.execute()
+        if price is None or funds is None or price > int(funds):
+            return None
+
+        pipe.hincrby(seller, 'funds', int(price))
+        pipe.hincrby(buyer, 'funds', int(-price))
+        pipe.sadd("inventory:%s" % buyerid, itemid)
+        pipe.zrem(market, item)
+        pipe.execute()
+        return True
+    finally:
+        release_lock(conn, market, locked)
+
+def browse_market(conn, min='-inf', max='inf', start=0, num=10,
+                  shards=MARKET_SHARDS):
+    pipe = conn.pipeline(False)
+    for shard in range(shards):
+        pipe.zrangebyscore('market:%s'%shard, min, max,             #F
+            start=0, num=start+num, withscores=True)                #F
+
+    def key(pair):
+        return pair[1], pair[0]
+    merged = heapq.merge(*pipe.execute(), key=key)                  #G
+    return list(itertools.islice(merged, start, start+num))         #H
+# <end id="sharded-market"/>
+#A Listings for the same item id always go to the same shard
+#B Group the items by shard, so that we make one call per shard
+#C Reuse our bulk listing script, passing the shard instead of the single market ZSET
+#D Reuse our purchase script too; it only ever touches one shard
+#E Only buyers of items in the same shard wait on the same lock
+#F Every shard could hold all of the items on the page, so fetch enough from each one
+#G Each shard's results are already sorted, so we only need to merge them, by score then by member
+#H Return only the page that was requested
+#END
+
+# <start id="sharded-market-benchmark"/>
+SHARDED_PURCHASES = {
+    'lock': purchase_item_with_shard_lock,
+    'script': purchase_item_sharded,
+}
+
+market_connection = None
+
+def init_market_worker(redis_kwargs):
+    global market_connection
+    market_connection = redis.Redis(**redis_kwargs)
+
+def sharded_market_worker(variant, buyerid, listings, shards):
+    purchase = SHARDED_PURCHASES[variant]
+    bought = 0
+    for sellerid, itemid, price in listings:                        #A
+        if purchase(market_connection, buyerid, itemid, sellerid,
+                    price, shards=shards) in (True, PURCHASED):
+            bought += 1
+    return bought
+
+def benchmark_sharded_market(conn, shard_counts=(1, 2, 4, 8, 16),
+                             variant='lock', processes=4, items=2000,
+                             sellers=10, redis_kwargs=None):
+    if redis_kwargs is None:
+        kwargs = conn.connection_pool.connection_kwargs
+        redis_kwargs = dict((k, kwargs[k])
+            for k in ('host', 'port', 'db', 'password') if k in kwargs)
+    pool = multiprocessing.Pool(processes, init_market_worker, (redis_kwargs,))
+    results = []
+    try:
+        for shards in shard_counts:
+            listings = []
+            for seller in range(sellers):                           #B
+                prices = dict(('item%s'%i, i % 100 + 1)
+                    for i in range(seller, items, sellers))
+                conn.sadd('inventory:seller%s'%seller, *prices)
+                list_items_sharded(conn, 'seller%s'%seller, prices, shards)
+                listings.extend(('seller%s'%seller, itemid, price)
+                    for itemid, price in prices.items())
+            for buyer in range(processes):
+                conn.hset('users:buyer%s'%buyer, 'funds', items * 100)
+
+            tasks = []
+            for buyer in range(processes):
+                random.shuffle(listings)                            #C
+                tasks.append((variant, 'buyer%s'%buyer, list(listings), shards))
+            start = time.time()
+            bought = sum(pool.starmap(sharded_market_worker, tasks))
+            delta = time.time() - start
+            results.append((shards, bought / delta))
+            print(variant, shards, bought, delta, bought / delta)   #D
+
+            conn.delete(*(['market:%s'%shard for shard in range(shards)] +
+                ['users:buyer%s'%buyer for buyer in range(processes)] +
+                ['inventory:buyer%s'%buyer for buyer in range(processes)] +
+                ['users:seller%s'%seller for seller in range(sellers)]))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+# <end id="sharded-market-benchmark"/>
+#A Each buyer process tries to buy every item, competing with the other buyers
+#B List the same items for every shard count
+#C Each buyer goes through the items in a different order
+#D Print the number of items sold per second for this number of shards
+#END
+
 
 # <start id="update-token"/>
 def update_token(conn, token, user, item=None):
@@ -240,23 +900,122 @@ def update_token_pipeline(conn, token, user, item=None):
 #B Execute the commands in the pipeline
 #END
 
+# <start id="session-recorder"/>
+class SessionRecorder(object):
+    def __init__(self, conn, interval=.1, max_events=1000):
+        self.conn = conn
+        self.interval = interval                            #A
+        self.max_events = max_events                        #A
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.quit = False
+        self._reset()
+
+    def _reset(self):
+        self.tokens = {}                                    #B
+        self.views = {}                                     #B
+        self.counts = {}                                    #B
+        self.events = 0
+
+    def update_token(self, token, user, item=None):
+        timestamp = time.time()
+        with self.lock:
+            self.tokens[token] = (user, timestamp)          #C
+            if item:
+                viewed = self.views.setdefault(token, {})   #C
+                viewed.pop(item, None)                      #C
+                viewed[item] = timestamp                    #C
+                if len(viewed) > 25:                        #D
+                    del viewed[next(iter(viewed))]          #D
+                self.counts[item] = self.counts.get(item, 0) + 1
+            self.events += 1
+            full = self.events >= self.max_events
+        if full:
+            self.flush()                                    #E
+
+    def flush(self):
+        with self.flush_lock:                               #F
+            with self.lock:
+                tokens, views, counts = self.tokens, self.views, self.counts
+                self._reset()
+            if not tokens:
+                return 0
+
+            pipe = self.conn.pipeline(False)                #G
+            pipe.hset('login:', mapping=dict(
+                (token, user) for token, (user, _) in tokens.items()))
+            pipe.zadd('recent:', dict(
+                (token, ts) for token, (_, ts) in tokens.items()))
+            for token, viewed in views.items():
+                pipe.zadd('viewed:' + token, viewed)
+                pipe.zremrangebyrank('viewed:' + token, 0, -26)
+            for item, count in counts.items():
+                pipe.zincrby('viewed:', -count, item)
+            pipe.execute()
+            return len(tokens)
+
+    def _run(self):
+        while not self.quit:
+            time.sleep(self.interval)                       #H
+            self.flush()                                    #H
+
+    def start(self):
+        self.quit = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.quit = True
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.flush()                                        #I
+# <end id="session-recorder"/>
+#A Flush every interval seconds, or after max_events calls, whichever comes first
+#B Buffered logins and last-seen times, recently viewed items, and view counts
+#C Repeated updates for the same token or item in one window only keep the most recent login and timestamp
+#D Only keep the most recent 25 items locally, just like Redis will
+#E If we've buffered enough events, flush them right now
+#F Only one flush at a time, so that older updates can't overwrite newer ones
+#G Send everything we buffered in one non-transactional pipeline
+#H Flush periodically from a background thread
+#I Make sure that nothing is lost when we stop
+#END
+
 # <start id="simple-pipeline-benchmark-code"/>
 def benchmark_update_token(conn, duration):
-    for function in (update_token, update_token_pipeline):      #A
+    recorder = SessionRecorder(conn)
+    def update_token_buffered(conn, token, user, item=None):    #F
+        recorder.update_token(token, user, item)                #F
+
+    for function in (update_token, update_token_pipeline,       #A
+                     update_token_buffered):                    #A
         count = 0                                               #B
+        latencies = []                                          #B
         start = time.time()                                     #B
         end = start + duration                                  #B
         while time.time() < end:
             count += 1
+            call_start = time.time()
             function(conn, 'token', 'user', 'item')             #C
+            latencies.append(time.time() - call_start)          #G
+        recorder.flush()                                        #H
         delta = time.time() - start                             #D
-        print(function.__name__, count, delta, count / delta)    #E
+        latencies.sort()                                        #I
+        p99 = latencies[min(int(len(latencies) * .99), len(latencies) - 1)]#I
+        print(function.__name__, count, delta, count / delta, p99)  #E
 # <end id="simple-pipeline-benchmark-code"/>
-#A Execute both the update_token() and the update_token_pipeline() functions
+#A Execute the update_token(), update_token_pipeline(), and buffered SessionRecorder versions
 #B Set up our counters and our ending conditions
-#C Call one of the two functions
+#C Call one of the functions
 #D Calculate the duration
-#E Print information about the results
+#E Print information about the results, including the 99th percentile latency of a single call
+#F The buffered recorder doesn't need a connection for every call, so we adapt it to the same calling convention
+#G Record how long this one call took
+#H Make sure that buffered updates are included in the time taken
+#I Find the 99th percentile latency
 #END
 
 '''
@@ -284,6 +1043,10 @@ LRANGE (first 600 elements): 9041.59 requests per second
 
 #--------------- Below this line are helpers to test the code ----------------
 
+def count_log_line(pipe, line):
+    pipe.incr('log:lines')
+    pipe.incrby('log:bytes', len(line))
+
 class TestCh04(unittest.TestCase):
     def setUp(self):
         import redis
@@ -299,9 +1062,112 @@ class TestCh04(unittest.TestCase):
     # We can't test process_logs, as that would require writing to disk, which
     # we don't want to do.
 
+    def test_process_logs_parallel(self):
+        import io
+        import multiprocessing.dummy
+        import tempfile
+        conn = self.conn
+
+        with tempfile.TemporaryDirectory() as path:
+            lines = {
+                'a.log': [('line %s %s\n'%(i, 'x' * (i % 7))).encode() for i in range(50)],
+                'b.log': [('line %s\n'%i).encode() for i in range(30)] + [b'y' * 100 + b'\n', b'end'],
+            }
+            for fname, content in lines.items():
+                with open(os.path.join(path, fname), 'wb') as f:
+                    f.write(b''.join(content))
+            total = sum(len(b''.join(content)) for content in lines.values())
+
+            print("Batches end on line boundaries, whether we map the file or read it")
+            for fname, content in lines.items():
+                content = b''.join(content)
+                for start in (0, content.index(b'\n') + 1):
+                    batches = list(log_batches(os.path.join(path, fname), start, 64))
+                    self.assertEqual(b''.join(b[2] for b in batches), content[start:])
+                    self.assertTrue(all(b[2].endswith(b'\n') for b in batches[:-1]))
+                    self.assertEqual([b[:2] for b in batches[1:]],
+                        [(b[1], b[1] + len(b2[2])) for b, b2 in zip(batches, batches[1:])])
+                    self.assertEqual(batches, list(read_log_batches(
+                        io.BytesIO(content[start:]), start, 64)))
+
+            print("Let's crash after applying two batches, but only checkpointing one")
+            redis_kwargs = {'host': "redis-in-action-redis", 'db': 15}
+            init_log_worker(redis_kwargs)
+            batches = list(log_batches(os.path.join(path, 'a.log'), 0, 64))
+            for batch in batches[:2]:
+                process_log_batch(count_log_line, 'a.log', *batch)
+            conn.mset({'progress:file': 'a.log', 'progress:position': batches[0][1],
+                'progress:batch-size': 64})
+            conn.srem('progress:done', 'a.log:0')
+
+            print("We can't resume with a different batch size, or the markers wouldn't match")
+            self.assertRaises(ValueError, process_logs_parallel, conn, path,
+                count_log_line, 2, 128, redis_kwargs, multiprocessing.dummy.Pool)
+
+            print("When we resume, the applied batch isn't counted twice")
+            process_logs_parallel(conn, path, count_log_line, 2, 64,
+                redis_kwargs, multiprocessing.dummy.Pool)
+            self.assertEqual(conn.get('log:lines'), str(len(lines['a.log']) + len(lines['b.log'])).encode())
+            self.assertEqual(conn.get('log:bytes'), str(total).encode())
+            self.assertEqual(conn.get('progress:file'), b'b.log')
+            self.assertEqual(conn.get('progress:position'), str(len(b''.join(lines['b.log']))).encode())
+            self.assertFalse(conn.smembers('progress:done'))
+
     # We also can't test wait_for_sync, as we can't guarantee that there are
     # multiple Redis servers running with the proper configuration
 
+    def test_durable_writer(self):
+        conn = self.conn
+
+        print("Let's write some data, and wait for it to be replicated")
+        writer = DurableWriter(conn, [conn])
+        token = writer.write(lambda pipe: pipe.set('durable', 1))
+        self.assertTrue(writer.wait_replicated(token, 0, site='single'))
+        print("Our writes and our waits share one connection")
+        used = []
+        pool = writer.conn.connection_pool
+        get_connection = pool.get_connection
+        def recording_get_connection(*args, **kwargs):
+            connection = get_connection(*args, **kwargs)
+            used.append(connection)
+            return connection
+        pool.get_connection = recording_get_connection
+        writer.use_wait['WAIT'] = True
+        writer.wait_replicated(writer.write(lambda pipe: pipe.incr('durable')), 0)
+        self.assertTrue(len(used) >= 2)
+        self.assertEqual(len(set(map(id, used))), 1)
+        conn.set('durable', 1)
+        print("We can also wait for a batch of writes at once")
+        tokens = writer.write_batch(
+            [lambda pipe, i=i: pipe.incr('durable', i) for i in range(10)], 0)
+        self.assertEqual(len(tokens), 10)
+        self.assertEqual(conn.get('durable'), b'46')
+
+        print("When using our server as its own replica, it has all of our tokens")
+        writer.use_wait['WAIT'] = False
+        self.assertTrue(writer.wait_replicated(token, 1, .1, site='single'))
+        self.assertFalse(writer.wait_replicated('missing', 1, .01, site='missing'))
+        print("Our latency histograms are:", writer.latency_histograms())
+        self.assertEqual(sum(c for b, c in writer.latency_histograms()['single']), 2)
+        self.assertTrue(writer.latency_percentile('missing', 99) >= .01)
+
+        print("A server without WAITAOF still uses WAIT")
+        class WaitOnly(object):
+            def __init__(self):
+                self.calls = []
+            def execute_command(self, *args):
+                self.calls.append(args)
+                if args[0] == 'WAITAOF':
+                    raise redis.exceptions.ResponseError("unknown command")
+                return 1
+        writer = DurableWriter(conn)
+        writer.conn = WaitOnly()
+        self.assertTrue(writer.wait_replicated('token', 1, 0))
+        self.assertFalse(writer.wait_replicated('token', 1, .01, fsync=True))
+        self.assertTrue(writer.wait_replicated('token', 1, 0))
+        self.assertEqual(writer.conn.calls[-1], ('WAIT', 1, 1))
+        self.assertEqual(writer.use_wait, {'WAIT': True, 'WAITAOF': False})
+
     def test_list_item(self):
         import pprint
         conn = self.conn
@@ -351,6 +1217,70 @@ class TestCh04(unittest.TestCase):
         self.assertTrue(b'itemX' in i)
         self.assertEqual(conn.zscore('market:', 'itemX.userX'), None)
 
+    def test_purchase_item_scripted(self):
+        conn = self.conn
+
+        print("Let's list a few items at once")
+        conn.sadd('inventory:userX', 'itemA', 'itemB', 'itemC', 'itemE')
+        r = list_items_scripted(conn, 'userX',
+            {'itemA': 10, 'itemB': 20, 'itemC': 'x', 'itemD': 5, 'itemE': 9.99})
+        print("Listing results:", r)
+        self.assertEqual(r, {'itemA': LISTED, 'itemB': LISTED,
+            'itemC': BAD_PRICE, 'itemD': NOT_IN_INVENTORY, 'itemE': BAD_PRICE})
+        self.assertEqual(conn.zcard('market:'), 2)
+
+        print("Purchases fail with a reason")
+        self.assertEqual(purchase_item_scripted(conn, 'userY', 'itemA', 'userX', 10), NO_ACCOUNT)
+        conn.hset('users:userY', 'funds', 15)
+        self.assertEqual(purchase_item_scripted(conn, 'userY', 'itemA', 'userX', 11), PRICE_CHANGED)
+        self.assertEqual(purchase_item_scripted(conn, 'userY', 'itemB', 'userX'), INSUFFICIENT_FUNDS)
+        self.assertEqual(purchase_item_scripted(conn, 'userY', 'itemC', 'userX'), NOT_LISTED)
+        conn.zadd('market:', {'itemF.userX': 1.5})
+        self.assertEqual(purchase_item_scripted(conn, 'userY', 'itemF', 'userX'), BAD_PRICE)
+        self.assertEqual(purchase_item_lua_simple(conn, 'userY', 'itemF', 'userX'), None)
+        conn.zrem('market:', 'itemF.userX')
+        print("Or succeed")
+        self.assertEqual(purchase_item_scripted(conn, 'userY', 'itemA', 'userX', 10), PURCHASED)
+        self.assertEqual(conn.hget('users:userY', 'funds'), b'5')
+        self.assertEqual(conn.hget('users:userX', 'funds'), b'10')
+        self.assertEqual(conn.smembers('inventory:userY'), set([b'itemA']))
+        self.assertEqual(purchase_item_scripted(conn, 'userY', 'itemA', 'userX'), NOT_LISTED)
+
+    def test_sharded_market(self):
+        conn = self.conn
+
+        print("Let's list some items across 4 market shards")
+        conn.sadd('inventory:userX', *['item%s'%i for i in range(20)])
+        r = list_items_sharded(conn, 'userX',
+            dict(('item%s'%i, i) for i in range(20)), 4)
+        self.assertEqual(set(r.values()), set([LISTED]))
+        self.assertEqual(sum(conn.zcard('market:%s'%i) for i in range(4)), 20)
+        self.assertTrue(all(conn.zcard('market:%s'%i) < 20 for i in range(4)))
+
+        print("Browsing merges the shards in price order")
+        page = browse_market(conn, 5, 'inf', 2, 5, shards=4)
+        print("The page:", page)
+        self.assertEqual(page, [(('item%s.userX'%i).encode(), i) for i in range(7, 12)])
+
+        print("Let's buy items from different shards")
+        conn.hset('users:userY', 'funds', 10)
+        self.assertEqual(purchase_item_sharded(conn, 'userY', 'item3', 'userX', 3, 4), PURCHASED)
+        self.assertTrue(purchase_item_with_shard_lock(conn, 'userY', 'item4', 'userX', shards=4))
+        self.assertEqual(purchase_item_with_shard_lock(conn, 'userY', 'item4', 'userX', shards=4), None)
+        self.assertEqual(conn.hget('users:userY', 'funds'), b'3')
+        self.assertEqual(browse_market(conn, 0, 5, num=10, shards=4),
+            [(('item%s.userX'%i).encode(), i) for i in (0, 1, 2, 5)])
+
+        print("Item ids outside of Latin-1 shard fine too")
+        conn.sadd('inventory:userX', '\u20ac-item')
+        self.assertEqual(list_items_sharded(conn, 'userX', {'\u20ac-item': 1}, 4),
+            {'\u20ac-item': LISTED})
+        self.assertEqual(purchase_item_sharded(conn, 'userY', '\u20ac-item', 'userX', 1, 4), PURCHASED)
+
+    def test_benchmark_purchase_contention(self):
+        results = benchmark_purchase_contention(self.conn, (1, 4), 100)
+        self.assertEqual(len(results), 8)
+
     def test_benchmark_update_token(self):
         benchmark_update_token(self.conn, 5)
 
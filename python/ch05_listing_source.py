@@ -1,11 +1,16 @@
 
+import array
+import atexit
+import binascii
 import bisect
+from collections import deque
 import contextlib
 import csv
 from datetime import datetime
 import functools
 import json
 import logging
+import math
 import random
 import threading
 import time
@@ -13,6 +18,10 @@ import unittest
 import uuid
 
 import redis
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def to_bytes(x):
@@ -56,6 +65,113 @@ def log_recent(conn, name, message, severity=logging.INFO, pipe=None):
 #H Execute the two commands
 #END
 
+# <start id="recent-log-buffer"/>
+class BackgroundFlusher(object):
+    def __init__(self, conn, interval, at_exit=False):
+        self.conn = conn
+        self.interval = interval
+        self.at_exit = at_exit
+        self.lock = threading.Lock()                            #A
+        self.flush_lock = threading.Lock()                      #A
+        self.thread = None
+        self.quit = False
+
+    def _run(self):
+        while not self.quit:
+            time.sleep(self.interval)
+            try:
+                self.flush()                                    #B
+            except redis.exceptions.ConnectionError:
+                pass                                            #C
+
+    def start(self):
+        self.quit = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        if self.at_exit:
+            atexit.register(self.stop)                          #D
+
+    def stop(self):
+        self.quit = True
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.flush()                                            #E
+
+class RecentLogBuffer(BackgroundFlusher):
+    def __init__(self, conn, interval=.1, max_messages=1000, size=100):
+        BackgroundFlusher.__init__(self, conn, interval)        #F
+        self.max_messages = max_messages                        #F
+        self.size = size
+        self.buffers = {}
+        self.count = 0
+
+    def log(self, name, message, severity=logging.INFO):
+        severity = str(SEVERITY.get(severity, severity)).lower()
+        destination = 'recent:%s:%s'%(name, severity)
+        message = time.asctime() + ' ' + message
+        with self.lock:
+            buffer = self.buffers.get(destination)
+            if buffer is None:
+                buffer = self.buffers[destination] = deque(maxlen=self.size)#G
+            buffer.append(message)                              #H
+            self.count += 1
+            full = self.count >= self.max_messages
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:                                   #I
+            with self.lock:
+                buffers, self.buffers = self.buffers, {}
+                self.count = 0
+            if not buffers:
+                return 0
+
+            pipe = self.conn.pipeline(True)
+            for destination, messages in buffers.items():
+                pipe.lpush(destination, *messages)              #J
+                pipe.ltrim(destination, 0, self.size - 1)       #K
+            try:
+                pipe.execute()
+            except redis.exceptions.ConnectionError:
+                with self.lock:                                 #L
+                    for destination, messages in buffers.items():
+                        self.count += len(messages)
+                        messages.extend(self.buffers.get(destination, ()))
+                        self.buffers[destination] = messages
+                raise
+            return sum(map(len, buffers.values()))
+
+class RecentLogHandler(logging.Handler):
+    def __init__(self, buffer, name=None, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.buffer = buffer
+        self.name = name
+
+    def emit(self, record):
+        try:
+            self.buffer.log(self.name or record.name,           #M
+                self.format(record), record.levelno)            #M
+        except Exception:
+            self.handleError(record)
+# <end id="recent-log-buffer"/>
+#A The lock protects the locally buffered data, and the flush lock lets only one flush run at a time
+#B Subclasses buffer their data under the lock, and send it to Redis in flush()
+#C If Redis is unavailable, the thread keeps going, and flush() has kept the data to try again on the next pass
+#D Optionally flush anything that is left when the process exits normally
+#E Make sure that nothing is lost when we stop
+#F Flush every interval seconds, or after max_messages calls, whichever comes first
+#G Each destination gets a ring buffer that only keeps as many messages as Redis would
+#H Messages are buffered in the order that they were logged
+#I Only one flush at a time, so that messages from a later flush can't be pushed before messages from an earlier one
+#J LPUSH with many messages pushes them in order, so the most recent message still ends up first
+#K Trim the log list once for all of the messages
+#L If Redis was unavailable, put the messages back in front of any newer ones, still keeping at most size messages per destination
+#M Log records from the standard logging module go to the destination for their logger name and level
+#END
+
 # <start id="common_log"/>
 def log_common(conn, name, message, severity=logging.INFO, timeout=5):
     severity = str(SEVERITY.get(severity, severity)).lower()    #A
@@ -99,6 +215,119 @@ def log_common(conn, name, message, severity=logging.INFO, timeout=5):
 #M If we got a watch error from someone else archiving, try again
 #END
 
+# <start id="script-load"/>
+def script_load(script):
+    sha = [None]
+    def call(conn, keys=[], args=[], force_eval=False):
+        if not force_eval:
+            if not sha[0]:
+                sha[0] = conn.execute_command(
+                    "SCRIPT", "LOAD", script, parse="LOAD")
+
+            try:
+                return conn.execute_command(
+                    "EVALSHA", sha[0], len(keys), *(keys+args))
+
+            except redis.exceptions.ResponseError as msg:
+                if not msg.args[0].startswith("NOSCRIPT"):
+                    raise
+
+        return conn.execute_command(
+            "EVAL", script, len(keys), *(keys+args))
+
+    return call
+# <end id="script-load"/>
+
+# <start id="common-log-scripted"/>
+def log_common_scripted(conn, name, messages, severity=logging.INFO,
+                        force_eval=False):
+    if not isinstance(messages, dict):
+        messages = {messages: 1}                                #A
+    severity = str(SEVERITY.get(severity, severity)).lower()
+    destination = 'common:%s:%s'%(name, severity)
+    now = datetime.utcnow().timetuple()
+    hour_start = datetime(*now[:4]).isoformat()                 #B
+    args = [hour_start, time.asctime()]
+    for message, count in messages.items():
+        args.extend([message, count])
+    return log_common_lua(conn,
+        [destination, destination + ':start', destination + ':last',
+         destination + ':pstart', 'recent:%s:%s'%(name, severity)],
+        args, force_eval)
+
+log_common_lua = script_load('''
+local existing = redis.call('get', KEYS[2])
+local rotated = 0
+if not existing then
+    redis.call('set', KEYS[2], ARGV[1])
+elseif existing < ARGV[1] then                                  --C
+    if redis.call('exists', KEYS[1]) == 1 then
+        redis.call('rename', KEYS[1], KEYS[3])                  --D
+    end
+    redis.call('rename', KEYS[2], KEYS[4])                      --D
+    redis.call('set', KEYS[2], ARGV[1])                         --D
+    rotated = 1
+end
+for i = 3, #ARGV, 2 do
+    redis.call('zincrby', KEYS[1], ARGV[i+1], ARGV[i])          --E
+    redis.call('lpush', KEYS[5], ARGV[2] .. ' ' .. ARGV[i])     --F
+end
+redis.call('ltrim', KEYS[5], 0, 99)
+return rotated
+''')
+
+class CommonLogAggregator(BackgroundFlusher):
+    def __init__(self, conn, interval=1, max_messages=10000):
+        BackgroundFlusher.__init__(self, conn, interval)        #G
+        self.max_messages = max_messages                        #G
+        self.counts = {}
+        self.count = 0
+
+    def log(self, name, message, severity=logging.INFO):
+        severity = str(SEVERITY.get(severity, severity)).lower()
+        with self.lock:
+            counts = self.counts.setdefault((name, severity), {})
+            counts[message] = counts.get(message, 0) + 1        #H
+            self.count += 1
+            full = self.count >= self.max_messages
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                counts, self.counts = self.counts, {}
+                self.count = 0
+            if not counts:
+                return 0
+
+            pipe = self.conn.pipeline(True)
+            for (name, severity), messages in counts.items():
+                log_common_scripted(pipe, name, messages, severity, True)#I
+            try:
+                pipe.execute()
+            except redis.exceptions.ConnectionError:
+                with self.lock:                                 #J
+                    for key, messages in counts.items():
+                        pending = self.counts.setdefault(key, {})
+                        for message, count in messages.items():
+                            pending[message] = pending.get(message, 0) + count
+                            self.count += count
+                raise
+            return sum(map(len, counts.values()))
+# <end id="common-log-scripted"/>
+#A We can log one message, or a dictionary of messages and how many times each was seen
+#B Find the start of the current hour, just like log_common()
+#C If the current common log is for a previous hour, archive it, without any WATCH/MULTI/EXEC retries
+#D Move the old common log information to the archive, and update the start of the current hour
+#E Increment each message by the number of times it was seen
+#F Each distinct message is also added to the recent log once per call
+#G Flush every interval seconds, or after max_messages calls, whichever comes first
+#H Identical messages only cost a local increment until we flush
+#I Scripts in a pipeline can't recover from a missing script, so we send the whole script
+#J If Redis was unavailable, add the counts back so they will be sent with the next flush
+#END
+
 # <start id="update_counter"/>
 PRECISION = [1, 5, 60, 300, 3600, 18000, 86400]         #A
 
@@ -122,6 +351,72 @@ def update_counter(conn, name, count=1, now=None):
 #H Update the counter for the given name and time precision
 #END
 
+# <start id="counter-aggregator"/>
+class CounterAggregator(BackgroundFlusher):
+    def __init__(self, conn, interval=1, max_pending=10000, safe=False,
+                 known_ttl=300):
+        BackgroundFlusher.__init__(self, conn, interval, safe)  #A
+        self.max_pending = max_pending                          #A
+        self.safe = safe
+        self.known_ttl = known_ttl
+        self.known = {}
+        self.pending = {}
+        self.oldest = None
+
+    def update_counter(self, name, count=1, now=None):
+        now = now or time.time()
+        with self.lock:
+            for prec in PRECISION:
+                pnow = int(now / prec) * prec
+                key = ('%s:%s'%(prec, name), pnow)
+                self.pending[key] = self.pending.get(key, 0) + count   #B
+            if self.oldest is None:
+                self.oldest = time.time()
+            full = len(self.pending) >= self.max_pending
+            if self.safe:
+                full = full or time.time() - self.oldest >= self.interval   #C
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.oldest = None
+            if not pending:
+                return 0
+
+            now = time.time()
+            register = {}
+            for hash, pnow in pending:
+                if self.known.get(hash, 0) < now - self.known_ttl:  #D
+                    register[hash] = 0
+            pipe = self.conn.pipeline(True)
+            if register:
+                pipe.zadd('known:', register)                   #E
+            for (hash, pnow), count in pending.items():
+                pipe.hincrby('count:' + hash, pnow, count)      #F
+            try:
+                pipe.execute()
+            except redis.exceptions.ConnectionError:
+                with self.lock:                                 #G
+                    for key, count in pending.items():
+                        self.pending[key] = self.pending.get(key, 0) + count
+                    self.oldest = self.oldest or now
+                raise
+            for hash in register:
+                self.known[hash] = now
+            return len(pending)
+# <end id="counter-aggregator"/>
+#A Flush every interval seconds, or once we have max_pending counter slices, whichever comes first; in safe mode, also flush when the process exits
+#B Sum increments locally for each counter and time slice
+#C In safe mode, we also flush as part of the update if the background thread has fallen behind, so no more than interval seconds of counts can be lost
+#D Only register counters we haven't registered recently; we re-register every known_ttl seconds in case clean_counters() removed an empty counter
+#E Register all of the new counters with a single call
+#F Then add one increment for each counter slice, no matter how many updates it had
+#G If Redis was unavailable, put the counts back so they will be sent with the next flush
+#END
+
 # <start id="get_counter"/>
 def get_counter(conn, name, precision):
     hash = '%s:%s'%(precision, name)                #A
@@ -138,6 +433,57 @@ def get_counter(conn, name, precision):
 #D Sort our data so that older samples are first
 #END
 
+# <start id="get-counter-range"/>
+def choose_precision(step):
+    usable = [prec for prec in PRECISION if prec <= step and not step % prec]
+    return usable[-1] if usable else PRECISION[0]               #A
+
+def _counter_slots(precision, start, end, step):
+    precision = precision or choose_precision(step or PRECISION[0])
+    step = step or precision
+    if step % precision:
+        raise ValueError("step must be a multiple of the precision")
+    first = int(start // step) * step                           #B
+    return precision, step, list(range(first, int(end) + 1, precision))
+
+def _downsample(slots, values, step, as_numpy):
+    times = array.array('q')
+    counts = array.array('q')
+    for slot, value in zip(slots, values):
+        bucket = slot - slot % step
+        if not times or times[-1] != bucket:
+            times.append(bucket)
+            counts.append(0)
+        counts[-1] += int(value or 0)                           #C
+    if as_numpy and numpy is not None:
+        return numpy.frombuffer(times, 'int64'), numpy.frombuffer(counts, 'int64')#D
+    return times, counts
+
+def get_counter_range(conn, name, precision, start, end, step=None,
+                      as_numpy=False):
+    precision, step, slots = _counter_slots(precision, start, end, step)
+    values = conn.hmget('count:%s:%s'%(precision, name), slots) if slots else []#E
+    return _downsample(slots, values, step, as_numpy)
+
+def get_counter_ranges(conn, names, precision, start, end, step=None,
+                       as_numpy=False):
+    precision, step, slots = _counter_slots(precision, start, end, step)
+    if not slots:
+        return dict((name, _downsample([], [], step, as_numpy)) for name in names)
+    pipe = conn.pipeline(False)
+    for name in names:
+        pipe.hmget('count:%s:%s'%(precision, name), slots)      #F
+    return dict((name, _downsample(slots, values, step, as_numpy))
+        for name, values in zip(names, pipe.execute()))
+# <end id="get-counter-range"/>
+#A Use the coarsest precision that evenly divides the step, which means fetching the fewest samples
+#B Align the range to the step, so that every bucket covers a whole step
+#C Sum up the samples for each step, with missing samples counting as 0
+#D Return numpy arrays that share memory with our arrays, if requested and available
+#E Only fetch the samples that we need, instead of the whole counter
+#F Fetch many counters for the same time range in a single round trip
+#END
+
 # <start id="clean_counters"/>
 def clean_counters(conn):
     pipe = conn.pipeline(True)
@@ -203,6 +549,87 @@ def clean_counters(conn):
 #T Sleep the remainder of the 60 seconds, or at least 1 second, just to offer a bit of a rest
 #END
 
+# <start id="sharded-counter-cleaner"/>
+COUNTER_CLEANER_STATS = {'passes': 0, 'duration': 0.0, 'removed': 0, 'counters': 0}
+STATS_LOCK = threading.Lock()
+
+def clean_counters_sharded(conn, worker=0, workers=1, page=1000, stats=None):
+    stats = COUNTER_CLEANER_STATS if stats is None else stats
+    passes = 0
+    while not QUIT:
+        start = time.time()
+        removed = counters = 0
+        cursor = None
+        while cursor != 0 and not QUIT:
+            cursor, hashes = conn.zscan('known:', cursor or 0, count=page)#A
+            pipe = conn.pipeline(False)
+            for hash, _ in hashes:
+                if binascii.crc32(hash) % workers != worker:    #B
+                    continue
+                prec = int(hash.partition(b':')[0])
+                bprec = int(prec // 60) or 1
+                if passes % bprec:                              #C
+                    continue
+                cutoff = time.time() - SAMPLE_COUNT * prec
+                trim_counter_lua(pipe, ['count:' + to_str(hash), 'known:'],#D
+                    [cutoff, hash], force_eval=True)            #D
+            for samples, deleted in pipe.execute():
+                removed += samples
+                counters += deleted
+
+        passes += 1
+        duration = time.time() - start
+        with STATS_LOCK:                                        #E
+            stats['passes'] += 1                                #E
+            stats['duration'] = duration                        #E
+            stats['removed'] += removed                         #E
+            stats['counters'] += counters                       #E
+        time.sleep(max(60 - min(int(duration) + 1, 60), 1))
+
+trim_counter_lua = script_load('''
+local cutoff = tonumber(ARGV[1])
+local samples = redis.call('hkeys', KEYS[1])
+local old = {}
+local removed = 0
+for i, sample in ipairs(samples) do
+    if tonumber(sample) <= cutoff then
+        old[#old + 1] = sample
+        if #old >= 1000 then                                    --F
+            removed = removed + redis.call('hdel', KEYS[1], unpack(old))
+            old = {}
+        end
+    end
+end
+if #old > 0 then
+    removed = removed + redis.call('hdel', KEYS[1], unpack(old))
+end
+if removed == #samples then
+    redis.call('zrem', KEYS[2], ARGV[2])                        --G
+    return {removed, 1}
+end
+return {removed, 0}
+''')
+
+def start_counter_cleaners(conn, workers=4, page=1000, stats=None):
+    threads = []
+    for i in range(workers):                                    #H
+        t = threading.Thread(target=clean_counters_sharded,     #H
+            args=(conn, i, workers, page, stats))               #H
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    return threads
+# <end id="sharded-counter-cleaner"/>
+#A Fetch a large page of known counters at a time, which is safe even as counters are removed
+#B Each worker only cleans the counters whose names hash to it
+#C Clean counters at roughly the rate that they are written to, just like clean_counters()
+#D Trim each counter on the server, without fetching its sample times, and send all of the trims for the page at once
+#E Report how long the pass took, and how much it cleaned
+#F Delete old samples in chunks, so we don't pass too many arguments at once
+#G The counter is empty, so it can be removed from the known counters in the same step, without needing to WATCH it
+#H Start one worker for each part of the counter names
+#END
+
 # <start id="update_stats"/>
 def update_stats(conn, context, type, value, timeout=5):
     destination = 'stats:%s:%s'%(context, type)                 #A
@@ -253,6 +680,253 @@ def update_stats(conn, context, type, value, timeout=5):
 #H If the hour just turned over and the stats have already been shuffled over, try again
 #END
 
+# <start id="update-stats-scripted"/>
+def summarize(values):
+    values = list(values)
+    return [len(values), sum(values), sum(v * v for v in values),   #A
+        min(values), max(values)]                                   #A
+
+def merge_summaries(a, b):
+    return [a[0] + b[0], a[1] + b[1], a[2] + b[2],                  #B
+        min(a[3], b[3]), max(a[4], b[4])]                           #B
+
+def update_stats_summary(conn, context, type, summary, force_eval=False):
+    destination = 'stats:%s:%s'%(context, type)
+    now = datetime.utcnow().timetuple()
+    hour_start = datetime(*now[:4]).isoformat()
+    return update_stats_lua(conn,
+        [destination, destination + ':start', destination + ':last',
+         destination + ':pstart'],
+        [hour_start] + list(summary), force_eval)
+
+def update_stats_batch(conn, context, type, values, force_eval=False):
+    if not values:
+        return None
+    result = update_stats_summary(conn, context, type, summarize(values),
+        force_eval)
+    return result if force_eval else [float(v) for v in result]
+
+def update_stats_scripted(conn, context, type, value):
+    return update_stats_batch(conn, context, type, [value])
+
+update_stats_lua = script_load('''
+local existing = redis.call('get', KEYS[2])
+if not existing then
+    redis.call('set', KEYS[2], ARGV[1])
+elseif existing < ARGV[1] then                                  --C
+    if redis.call('exists', KEYS[1]) == 1 then
+        redis.call('rename', KEYS[1], KEYS[3])
+    end
+    redis.call('rename', KEYS[2], KEYS[4])
+    redis.call('set', KEYS[2], ARGV[1])
+end
+
+local min = redis.call('zscore', KEYS[1], 'min')
+if not min or tonumber(ARGV[5]) < tonumber(min) then
+    redis.call('zadd', KEYS[1], ARGV[5], 'min')                 --D
+end
+local max = redis.call('zscore', KEYS[1], 'max')
+if not max or tonumber(ARGV[6]) > tonumber(max) then
+    redis.call('zadd', KEYS[1], ARGV[6], 'max')                 --D
+end
+return {
+    redis.call('zincrby', KEYS[1], ARGV[2], 'count'),           --E
+    redis.call('zincrby', KEYS[1], ARGV[3], 'sum'),             --E
+    redis.call('zincrby', KEYS[1], ARGV[4], 'sumsq'),           --E
+}
+''')
+
+class StatsAggregator(BackgroundFlusher):
+    def __init__(self, conn, interval=1, max_samples=10000, sketches=False):
+        BackgroundFlusher.__init__(self, conn, interval)        #F
+        self.sketches = sketches
+        self.max_samples = max_samples                          #F
+        self.summaries = {}
+        self.quantiles = {}
+        self.count = 0
+
+    def update_stats(self, context, type, value):
+        with self.lock:
+            key = (context, type)
+            summary = [1, value, value * value, value, value]
+            if key in self.summaries:
+                summary = merge_summaries(self.summaries[key], summary)#G
+            self.summaries[key] = summary
+            if self.sketches:
+                if key not in self.quantiles:
+                    self.quantiles[key] = QuantileSketch()
+                self.quantiles[key].add(value)
+            self.count += 1
+            full = self.count >= self.max_samples
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                summaries, self.summaries = self.summaries, {}
+                quantiles, self.quantiles = self.quantiles, {}
+                self.count = 0
+            if not summaries and not quantiles:
+                return {}
+
+            keys = list(summaries)
+            pipe = self.conn.pipeline(False)
+            for context, type in keys:
+                update_stats_summary(pipe, context, type,       #H
+                    summaries[context, type], True)             #H
+            try:
+                results = dict((key, [float(v) for v in result])
+                    for key, result in zip(keys, pipe.execute()))
+            except redis.exceptions.ConnectionError:
+                with self.lock:                                 #L
+                    for key, summary in summaries.items():
+                        if key in self.summaries:
+                            summary = merge_summaries(self.summaries[key], summary)
+                        self.summaries[key] = summary
+                        self.count += summary[0]
+                    self._restore_quantiles(quantiles)
+                raise
+
+            slowest = dict((context, stats[1] / stats[0])      #I
+                for (context, type), stats in results.items()   #I
+                if type == 'AccessTime')                        #I
+            if quantiles:
+                try:
+                    hour = update_sketches(self.conn, quantiles,#K
+                        [key for key in quantiles if key[1] == 'AccessTime'])
+                except redis.exceptions.ConnectionError:
+                    with self.lock:
+                        self._restore_quantiles(quantiles)      #M
+                    raise
+                slowest = dict((context, sketch.quantile(.99))  #K
+                    for (context, type), sketch in hour.items())#K
+            if slowest:
+                pipe.zadd('slowest:AccessTime', slowest)
+                pipe.zremrangebyrank('slowest:AccessTime', 0, -101)
+                pipe.execute()
+            return results
+
+    def _restore_quantiles(self, quantiles):
+        for key, sketch in quantiles.items():
+            if key in self.quantiles:
+                sketch.merge(self.quantiles[key])
+            self.quantiles[key] = sketch
+
+@contextlib.contextmanager
+def access_time_aggregated(aggregator, context):
+    start = time.time()
+    yield
+    aggregator.update_stats(context, 'AccessTime', time.time() - start)#J
+# <end id="update-stats-scripted"/>
+#A Summarize many samples locally as their count, sum, sum of squares, minimum and maximum
+#B Summaries from different samples, threads, or hosts can be combined
+#C Handle the current hour/last hour like in update_stats(), but inside the script, so there are no WATCH retries
+#D Update the minimum and maximum without temporary ZSETs
+#E Update the count, sum, and sum of squares, and return them like update_stats()
+#F Flush every interval seconds, or after max_samples samples, whichever comes first
+#G Merge each new sample into the summary for its context and type
+#H Send one script call for each context and type, no matter how many samples it had
+#I Update the slowest access times from the fresh statistics, like access_time()
+#J Timing a block of code only costs a local update
+#K With sketches, we also add our samples to the quantile sketches for this hour, and rank the slowest access times by their 99th percentile
+#L If Redis was unavailable, merge the summaries back so they will be sent with the next flush
+#M Sketches are only sent after the summaries, so if only they failed, only they are merged back
+#END
+
+# <start id="quantile-sketch"/>
+SKETCH_ACCURACY = .01                                           #A
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)    #A
+SKETCH_MIN = 1e-9
+SKETCH_TTL = 7 * 86400
+
+class QuantileSketch(object):
+    def __init__(self, buckets=None):
+        self.buckets = dict(buckets or {})
+
+    @classmethod
+    def from_hash(cls, data):
+        return cls((int(k), int(v)) for k, v in data.items())  #B
+
+    def add(self, value, count=1):
+        index = int(math.ceil(                                  #C
+            math.log(max(value, SKETCH_MIN), SKETCH_GAMMA)))    #C
+        self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def merge(self, other):
+        for index, count in other.buckets.items():              #D
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        return self
+
+    def count(self):
+        return sum(self.buckets.values())
+
+    def quantile(self, q):
+        total = self.count()
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return 2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1)   #E
+        return 2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1)
+
+def sketch_key(context, type, hour_start=None):
+    if hour_start is None:
+        now = datetime.utcnow().timetuple()
+        hour_start = datetime(*now[:4]).isoformat()
+    return 'sketch:%s:%s:%s'%(context, type, hour_start)        #F
+
+def update_sketches(conn, sketches, fetch=()):
+    pipe = conn.pipeline(True)
+    for (context, type), sketch in sketches.items():
+        key = sketch_key(context, type)
+        for index, count in sketch.buckets.items():
+            pipe.hincrby(key, index, count)                     #G
+        pipe.expire(key, SKETCH_TTL)
+    for context, type in fetch:
+        pipe.hgetall(sketch_key(context, type))                 #H
+    results = pipe.execute()
+    fetched = results[len(results) - len(fetch):]
+    return dict((key, QuantileSketch.from_hash(data))
+        for key, data in zip(fetch, fetched))
+
+def get_sketch(conn, context, type, hours=1, now=None):
+    now = now or time.time()
+    pipe = conn.pipeline(False)
+    for hour in range(hours):
+        then = datetime.utcfromtimestamp(now - hour * 3600).timetuple()
+        pipe.hgetall(sketch_key(context, type,                  #I
+            datetime(*then[:4]).isoformat()))                   #I
+    sketch = QuantileSketch()
+    for data in pipe.execute():
+        sketch.merge(QuantileSketch.from_hash(data))
+    return sketch
+
+def get_stats_percentiles(conn, context, type, percentiles=(50, 95, 99),
+                          hours=1):
+    data = {}
+    if conn.exists('stats:%s:%s'%(context, type)):
+        data = get_stats(conn, context, type)
+    sketch = get_sketch(conn, context, type, hours)
+    for p in percentiles:
+        data[('p%s'%p).encode()] = sketch.quantile(p / 100.)    #J
+    return data
+# <end id="quantile-sketch"/>
+#A Every quantile is within 1% of the true value, by putting values into buckets whose bounds grow by a factor of gamma
+#B Sketches are stored in Redis as a HASH of bucket index to count, which is small and compact
+#C Find the bucket for this value; we treat tiny and non-positive values as the smallest value we track
+#D Sketches from different hosts or hours are merged by adding up their buckets
+#E Return the middle of the bucket that holds the requested rank, which is within our accuracy of every value in the bucket
+#F One sketch per context and type for each hour
+#G Every host adds its locally collected counts to the shared sketch
+#H Optionally fetch the whole sketch for this hour back, to rank contexts by their percentiles
+#I Fetch the sketches for the most recent hours
+#J Add the requested percentiles to the usual statistics
+#END
+
 # <start id="get_stats"/>
 def get_stats(conn, context, type):
     key = 'stats:%s:%s'%(context, type)                                 #A
@@ -486,6 +1160,16 @@ log_recent('main', 'User 235 logged in')    #C
 class request:
     pass
 
+class UnavailableConnection(object):
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        raise redis.exceptions.ConnectionError("Redis is unavailable")
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
 # a faster version with pipelines for actual testing
 def import_ips_to_redis(conn, filename):
     csv_file = csv.reader(open(filename, 'rb'))
@@ -553,6 +1237,47 @@ class TestCh05(unittest.TestCase):
         pprint.pprint(recent[:10])
         self.assertTrue(len(recent) >= 5)
 
+    def test_recent_log_buffer(self):
+        conn = self.conn
+
+        print("Let's buffer a few logs, and flush them all at once")
+        buffer = RecentLogBuffer(conn, max_messages=1000)
+        for msg in range(150):
+            buffer.log('test', 'this is message %s'%msg)
+        buffer.log('test', 'this is an error', logging.ERROR)
+        self.assertFalse(conn.exists('recent:test:info'))
+        self.assertEqual(buffer.flush(), 101)
+        recent = conn.lrange('recent:test:info', 0, -1)
+        print("The most recent messages are:", recent[:2])
+        self.assertEqual(len(recent), 100)
+        self.assertTrue(recent[0].endswith(b'message 149'))
+        self.assertTrue(recent[-1].endswith(b'message 50'))
+        self.assertEqual(conn.llen('recent:test:error'), 1)
+
+        print("If Redis is unavailable, the messages are kept for the next flush")
+        buffer.conn = UnavailableConnection()
+        buffer.log('test', 'this is message 150')
+        self.assertRaises(redis.exceptions.ConnectionError, buffer.flush)
+        buffer.log('test', 'this is message 151')
+        buffer.conn = conn
+        self.assertEqual(buffer.flush(), 2)
+        self.assertTrue(conn.lindex('recent:test:info', 0).endswith(b'message 151'))
+        self.assertTrue(conn.lindex('recent:test:info', 1).endswith(b'message 150'))
+
+        print("We can also use it from the logging module")
+        logger = logging.getLogger('test-buffered')
+        logger.propagate = False
+        handler = RecentLogHandler(buffer, 'test')
+        logger.addHandler(handler)
+        buffer.start()
+        try:
+            logger.warning('this is a warning')
+        finally:
+            logger.removeHandler(handler)
+            buffer.stop()
+        self.assertEqual(conn.lrange('recent:test:warning', 0, -1)[0][-17:],
+            b'this is a warning')
+
     def test_log_common(self):
         import pprint
         conn = self.conn
@@ -567,6 +1292,41 @@ class TestCh05(unittest.TestCase):
         pprint.pprint(common)
         self.assertTrue(len(common) >= 5)
 
+    def test_log_common_scripted(self):
+        conn = self.conn
+
+        print("Let's write some items to the common log with a script")
+        self.assertEqual(log_common_scripted(conn, 'test', 'message-1'), 0)
+        log_common_scripted(conn, 'test', {'message-1': 2, 'message-2': 5})
+        common = conn.zrevrange('common:test:info', 0, -1, withscores=True)
+        print("The common messages are:", common)
+        self.assertEqual(common, [(b'message-2', 5), (b'message-1', 3)])
+        self.assertEqual(conn.llen('recent:test:info'), 3)
+
+        print("When the hour changes, the common log is archived")
+        conn.set('common:test:info:start', '2000-01-01T00:00:00')
+        self.assertEqual(log_common_scripted(conn, 'test', 'message-3'), 1)
+        self.assertEqual(conn.zcard('common:test:info:last'), 2)
+        self.assertEqual(conn.zrange('common:test:info', 0, -1), [b'message-3'])
+
+        print("Let's aggregate identical messages locally")
+        aggregator = CommonLogAggregator(conn)
+        for i in range(100):
+            aggregator.log('test', 'message-%s'%(i % 3), logging.WARNING)
+        self.assertEqual(aggregator.flush(), 3)
+        common = conn.zrevrange('common:test:warning', 0, -1, withscores=True)
+        print("The aggregated common messages are:", common)
+        self.assertEqual(common, [(b'message-0', 34), (b'message-2', 33), (b'message-1', 33)])
+
+        print("If Redis is unavailable, the counts are kept for the next flush")
+        aggregator.conn = UnavailableConnection()
+        aggregator.log('test', 'message-0', logging.WARNING)
+        self.assertRaises(redis.exceptions.ConnectionError, aggregator.flush)
+        aggregator.log('test', 'message-0', logging.WARNING)
+        aggregator.conn = conn
+        self.assertEqual(aggregator.flush(), 1)
+        self.assertEqual(conn.zscore('common:test:warning', 'message-0'), 36)
+
     def test_counters(self):
         import pprint
         global QUIT, SAMPLE_COUNT
@@ -603,6 +1363,99 @@ class TestCh05(unittest.TestCase):
         print("Did we clean out all of the counters?", not counter)
         self.assertFalse(counter)
 
+    def test_counter_aggregator(self):
+        conn = self.conn
+
+        print("Let's aggregate some counter updates locally")
+        aggregator = CounterAggregator(conn)
+        now = time.time()
+        for delta in range(100):
+            aggregator.update_counter('test', now=now + delta / 10.)
+        self.assertFalse(conn.exists('known:'))
+        slices = aggregator.flush()
+        print("We sent this many counter slices:", slices)
+        self.assertTrue(slices < 100 * len(PRECISION))
+        self.assertEqual(sum(v for k, v in get_counter(conn, 'test', 1)), 100)
+        self.assertEqual(sum(v for k, v in get_counter(conn, 'test', 86400)), 100)
+        self.assertEqual(conn.zcard('known:'), len(PRECISION))
+
+        print("Counters we already registered aren't registered again")
+        conn.delete('known:')
+        aggregator.update_counter('test', now=now)
+        aggregator.flush()
+        self.assertFalse(conn.exists('known:'))
+        aggregator.known_ttl = -1
+        aggregator.update_counter('test', now=now)
+        aggregator.flush()
+        self.assertEqual(conn.zcard('known:'), len(PRECISION))
+        self.assertEqual(sum(v for k, v in get_counter(conn, 'test', 1)), 102)
+
+        print("In safe mode, old counts are flushed as part of an update")
+        aggregator = CounterAggregator(conn, interval=0, safe=True)
+        aggregator.update_counter('test', now=now)
+        self.assertFalse(aggregator.pending)
+        self.assertEqual(sum(v for k, v in get_counter(conn, 'test', 1)), 103)
+
+    def test_get_counter_range(self):
+        conn = self.conn
+
+        print("Let's update a counter every second for 10 minutes")
+        now = int(time.time() // 300) * 300
+        pipe = conn.pipeline(False)
+        for delta in range(600):
+            update_counter(pipe, 'test', now=now+delta)
+        pipe.execute()
+
+        print("We can fetch per-minute counts")
+        self.assertEqual(choose_precision(60), 60)
+        self.assertEqual(choose_precision(120), 60)
+        self.assertEqual(choose_precision(7), 1)
+        times, counts = get_counter_range(conn, 'test', None, now, now + 599, 60)
+        print("The per-minute counts are:", list(zip(times, counts)))
+        self.assertEqual(list(times), list(range(now, now + 600, 60)))
+        self.assertEqual(list(counts), [60] * 10)
+
+        print("Or downsample per-second counts to 10-second counts")
+        times, counts = get_counter_range(conn, 'test', 1, now + 5, now + 29, 10)
+        self.assertEqual(list(times), [now, now + 10, now + 20])
+        self.assertEqual(list(counts), [10, 10, 10])
+        self.assertRaises(ValueError, get_counter_range, conn, 'test', 60, now, now + 600, 90)
+
+        print("And fetch many counters at once")
+        update_counter(conn, 'other', 5, now=now)
+        ranges = get_counter_ranges(conn, ['test', 'other', 'missing'], None, now, now + 599, 300)
+        self.assertEqual(list(ranges['test'][1]), [300, 300])
+        self.assertEqual(list(ranges['other'][1]), [5, 0])
+        self.assertEqual(list(ranges['missing'][1]), [0, 0])
+
+    def test_sharded_counter_cleaners(self):
+        global QUIT, SAMPLE_COUNT
+        conn = self.conn
+
+        print("Let's update some counters, and clean them with several workers")
+        now = time.time()
+        for name in range(10):
+            for delta in range(5):
+                update_counter(conn, 'test%s'%name, now=now+delta)
+        self.assertEqual(conn.zcard('known:'), 10 * len(PRECISION))
+
+        tt = time.time
+        def new_tt():
+            return tt() + 2*86400
+        time.time = new_tt
+
+        SAMPLE_COUNT = 0
+        stats = {'passes': 0, 'duration': 0.0, 'removed': 0, 'counters': 0}
+        start_counter_cleaners(conn, 3, 100, stats)
+        time.sleep(1)
+        QUIT = True
+        time.time = tt
+        print("The cleaners reported:", stats)
+        self.assertEqual(stats['passes'], 3)
+        self.assertEqual(stats['counters'], 10 * len(PRECISION))
+        self.assertFalse(conn.exists('known:'))
+        self.assertFalse(get_counter(conn, 'test0', 1))
+
     def test_stats(self):
         import pprint
         conn = self.conn
@@ -616,6 +1469,96 @@ class TestCh05(unittest.TestCase):
         pprint.pprint(rr)
         self.assertTrue(rr[b'count'] >= 5)
 
+    def test_stats_scripted(self):
+        conn = self.conn
+
+        print("Let's add some statistics with a script")
+        r = update_stats_scripted(conn, 'temp', 'example', 5)
+        self.assertEqual(r, [1, 5, 25])
+        r = update_stats_batch(conn, 'temp', 'example', [1, 2, 10])
+        print("We have some aggregate statistics:", r)
+        self.assertEqual(r, [4, 18, 130])
+        rr = get_stats(conn, 'temp', 'example')
+        self.assertEqual((rr[b'min'], rr[b'max'], rr[b'average']), (1, 10, 4.5))
+        print("An empty batch doesn't touch Redis")
+        self.assertEqual(update_stats_batch(conn, 'temp', 'example', []), None)
+        self.assertEqual(update_stats_batch(conn.pipeline(False), 'temp', 'example', [], True), None)
+        self.assertEqual(conn.zscore('stats:temp:example', 'count'), 4)
+
+        print("When the hour changes, the statistics are archived")
+        conn.set('stats:temp:example:start', '2000-01-01T00:00:00')
+        self.assertEqual(update_stats_scripted(conn, 'temp', 'example', 7), [1, 7, 49])
+        self.assertEqual(conn.zscore('stats:temp:example:last', 'count'), 4)
+
+        print("Let's aggregate access times locally")
+        aggregator = StatsAggregator(conn)
+        for i in range(100):
+            with access_time_aggregated(aggregator, 'req-%s'%(i % 2)):
+                pass
+        results = aggregator.flush()
+        self.assertEqual(results['req-0', 'AccessTime'][0], 50)
+        self.assertEqual(get_stats(conn, 'req-1', 'AccessTime')[b'count'], 50)
+        self.assertEqual(conn.zcard('slowest:AccessTime'), 2)
+        self.assertEqual(merge_summaries(summarize([1, 2]), summarize([3])), summarize([1, 2, 3]))
+
+        print("If Redis is unavailable, the summaries are kept for the next flush")
+        aggregator.conn = UnavailableConnection()
+        aggregator.update_stats('req-0', 'AccessTime', 1)
+        self.assertRaises(redis.exceptions.ConnectionError, aggregator.flush)
+        aggregator.update_stats('req-0', 'AccessTime', 2)
+        aggregator.conn = conn
+        self.assertEqual(aggregator.flush()['req-0', 'AccessTime'][:2], [52, 3 + results['req-0', 'AccessTime'][1]])
+
+    def test_quantile_sketch(self):
+        conn = self.conn
+
+        print("Let's add some values to a sketch")
+        sketch = QuantileSketch()
+        for i in range(1, 1001):
+            sketch.add(i / 1000.)
+        for q in (.5, .95, .99):
+            print("The", q, "quantile is about", sketch.quantile(q))
+            self.assertTrue(abs(sketch.quantile(q) - q) <= q * SKETCH_ACCURACY * 1.5)
+        other = QuantileSketch()
+        other.add(5, 1000)
+        self.assertEqual(sketch.merge(other).count(), 2000)
+        self.assertTrue(abs(sketch.quantile(.99) - 5) < .05)
+
+        print("Let's keep access time sketches in Redis")
+        aggregator = StatsAggregator(conn, sketches=True)
+        for i in range(200):
+            aggregator.update_stats('fast', 'AccessTime', .001 * (i % 2 + 1))
+            aggregator.update_stats('slow', 'AccessTime', .1 if i else 10)
+        aggregator.flush()
+        aggregator.update_stats('fast', 'AccessTime', .001)
+        aggregator.flush()
+        print("The slowest contexts by 99th percentile are:",
+            conn.zrevrange('slowest:AccessTime', 0, -1, withscores=True))
+        self.assertEqual(conn.zrevrange('slowest:AccessTime', 0, -1), [b'slow', b'fast'])
+        self.assertTrue(abs(conn.zscore('slowest:AccessTime', 'fast') - .002) < .0001)
+
+        stats = get_stats_percentiles(conn, 'slow', 'AccessTime')
+        print("The statistics for the slow context are:", stats)
+        self.assertEqual(stats[b'count'], 200)
+        self.assertTrue(abs(stats[b'p99'] - .1) < .002)
+
+        print("If only the sketches couldn't be sent, only they are kept for the next flush")
+        class SketchesUnavailable(object):
+            def pipeline(self, transaction=True):
+                return UnavailableConnection() if transaction else conn.pipeline(False)
+        aggregator.conn = SketchesUnavailable()
+        aggregator.update_stats('retried', 'AccessTime', .1)
+        self.assertRaises(redis.exceptions.ConnectionError, aggregator.flush)
+        self.assertEqual(get_stats(conn, 'retried', 'AccessTime')[b'count'], 1)
+        aggregator.conn = conn
+        self.assertEqual(aggregator.flush(), {})
+        self.assertEqual(get_sketch(conn, 'retried', 'AccessTime').count(), 1)
+
+        print("We can merge the sketches for several hours")
+        old = sketch_key('slow', 'AccessTime', datetime(*datetime.utcfromtimestamp(time.time() - 3600).timetuple()[:4]).isoformat())
+        conn.hset(old, mapping=dict((k, v * 10) for k, v in sketch.buckets.items()))
+        self.assertEqual(get_sketch(conn, 'slow', 'AccessTime', 2).count(), 20200)
+
     def test_access_time(self):
         import pprint
         conn = self.conn